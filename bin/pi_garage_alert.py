@@ -39,69 +39,224 @@ import time
 from time import strftime
 import subprocess
 import re
+import os
 import sys
+import argparse
 import json
 import logging
+import logging.handlers
+import queue
+import gzip
+import shutil
 from datetime import timedelta
 import smtplib
 import ssl
 import traceback
+import threading
+import collections
+import heapq
+import random
+import sqlite3
+import array
+import itertools
+import importlib
+import resource
+import concurrent.futures
+import fcntl
+import select
+import struct
+import asyncio
+import signal
+import types
+import ctypes
+import ctypes.util
 from email.mime.text import MIMEText
+from email.utils import parsedate_to_datetime
 
-import requests
-import tweepy
-import RPi.GPIO as GPIO
-import sleekxmpp
-from sleekxmpp.xmlstream import resolver, cert
-from twilio.rest import Client
-from twilio.base.exceptions import TwilioRestException
-import slack
+# RPi.GPIO is imported by RPiGpioBackend, so the daemon can also run with
+# other sensor backends on machines without it.
+# The sender SDKs (requests, tweepy, twilio, sleekxmpp, slack) are imported
+# by the senders themselves, and only senders for channels the config
+# actually uses are created. See SENDERS.
 
 sys.path.append('/usr/local/etc')
 import pi_garage_alert_config as cfg
 
+##############################################################################
+# HTTP support
+##############################################################################
+
+class HttpTransport:
+    """Connection-pooled HTTP client shared by the HTTP based senders
+
+    Keeps connections to each service alive between alerts so an alert
+    doesn't have to pay for DNS, TCP and TLS setup every time.
+    """
+
+    def __init__(self, connect_timeout=5, read_timeout=15, pool_size=4):
+        import requests
+        import requests.adapters
+
+        self.logger = logging.getLogger(__name__)
+        self.timeout = (connect_timeout, read_timeout)
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def request(self, method, url, **kwargs):
+        """Send a request using a pooled connection
+
+        Args:
+            method: HTTP method
+            url: URL to request
+            kwargs: Passed on to requests. The default timeout is used if
+                    none is given.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        """Send a GET request"""
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """Send a POST request"""
+        return self.request('POST', url, **kwargs)
+
+    def prewarm(self, urls):
+        """Open connections to the given URLs ahead of the first alert
+
+        Args:
+            urls: List of URLs. Only the scheme and host matter.
+        """
+        import requests
+
+        for url in urls:
+            try:
+                self.request('HEAD', url)
+                self.logger.info("Pre-warmed HTTP connection to %s", url)
+            except requests.exceptions.RequestException as ex:
+                self.logger.warning("Unable to pre-warm HTTP connection to %s: %s", url, ex)
+
+    def pool_stats(self):
+        """Returns a dict with the number of requests which reused a pooled
+        connection (hits) and which had to open a new one (misses)"""
+        hits = 0
+        misses = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                misses += pool.num_connections
+                hits += pool.num_requests - pool.num_connections
+        return {'hits': max(hits, 0), 'misses': misses}
+
 ##############################################################################
 # Cisco Spark support
 ##############################################################################
 class CiscoSpark:
-    """Class to send Cisco Spark messages"""
+    """Class to send Cisco Spark messages
 
-    def __init__(self):
+    Room IDs are cached by title so a message to a known room only costs
+    one API call. The cache is saved to cfg.SPARK_ROOM_CACHE_FILENAME so
+    it survives restarts.
+    """
+
+    def __init__(self, transport):
         self.logger = logging.getLogger(__name__)
+        self.transport = transport
+        self.timeout = channel_timeout('CiscoSpark', transport.timeout)
+        self.api_url = getattr(cfg, 'SPARK_API_URL', 'https://api.ciscospark.com/v1')
         self.header = None
-        self.rooms = {"items": []}
-        self.room_id = None
+        self.lock = threading.Lock()
+        self.cache_filename = getattr(cfg, 'SPARK_ROOM_CACHE_FILENAME', None)
+        self.cache_ttl = getattr(cfg, 'SPARK_ROOM_CACHE_TTL', 86400)
+
+        # Room title -> (room ID, time.time() the entry expires)
+        self.room_cache = self.load_cache()
 
     def headers(self):
         access_token_hdr = 'Bearer ' + cfg.SPARK_ACCESSTOKEN
         spark_header = {'Authorization': access_token_hdr, 'Content-Type': 'application/json; charset=utf-8'}
         return spark_header
 
-    def get_rooms(self):
-        uri = 'https://api.ciscospark.com/v1/rooms'
-        resp = requests.get(uri, headers=self.headers)
-        return resp.json()
+    def load_cache(self):
+        """Returns the room cache saved by a previous run, if any"""
+        if not self.cache_filename:
+            return {}
+        try:
+            with open(self.cache_filename, 'r') as cache_file:
+                return {title: tuple(entry) for title, entry in json.load(cache_file).items()}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as ex:
+            self.logger.warning("Unable to load Spark room cache %s: %s", self.cache_filename, ex)
+            return {}
+
+    def save_cache(self):
+        """Atomically replace the saved room cache"""
+        if not self.cache_filename:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_filename) or '.', exist_ok=True)
+            tmp_filename = self.cache_filename + '.tmp'
+            with open(tmp_filename, 'w') as cache_file:
+                json.dump(self.room_cache, cache_file)
+            os.replace(tmp_filename, self.cache_filename)
+        except OSError as ex:
+            self.logger.warning("Unable to save Spark room cache %s: %s", self.cache_filename, ex)
+
+    def cache_room(self, title, room_id):
+        """Add a room to the cache"""
+        self.room_cache[title] = (room_id, time.time() + self.cache_ttl)
+
+    def get_rooms(self, name=None):
+        """Walk the paginated room list, caching every room seen
+
+        Args:
+            name: Stop as soon as a room with this title is found
+
+        Returns:
+            ID of the room called name, or None if it wasn't found
+        """
+        uri = self.api_url + '/rooms?max=100'
+        while uri:
+            resp = self.transport.get(uri, headers=self.header, timeout=self.timeout)
+            resp.raise_for_status()
+            for room in resp.json()["items"]:
+                self.cache_room(room["title"], room["id"])
+                if room["title"] == name:
+                    return room["id"]
+            uri = resp.links.get('next', {}).get('url')
+        return None
 
     def find_room(self, name):
-        room_id = 0
-        for room in self.rooms["items"]:
-            if room["title"] == name:
-                room_id = room["id"]
-                break
+        """Returns the ID of the named room, creating the room if needed"""
+        entry = self.room_cache.get(name)
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+
+        room_id = self.get_rooms(name)
+        if room_id is None:
+            self.logger.info("Specified room %s was not found! Creating.", name)
+            room_id = self.add_room(name)["id"]
+            self.cache_room(name, room_id)
+        self.save_cache()
         return room_id
 
     def add_room(self, name):
-        uri = 'https://api.ciscospark.com/v1/rooms'
+        uri = self.api_url + '/rooms'
         payload = {"title": name}
-        resp = requests.post(uri, data=json.dumps(payload), headers=self.headers)
+        resp = self.transport.post(uri, data=json.dumps(payload), headers=self.header, timeout=self.timeout)
+        resp.raise_for_status()
         return resp.json()
 
-    def add_message_to_room(self, message):
-        self.logger.info("In the Spark addMessageToRoom function. Adding to room ID %s", str(self.room_id))
-        uri = "https://api.ciscospark.com/v1/messages"
-        payload = {"roomId": self.room_id, "text": message}
-        resp = requests.post(uri, data=json.dumps(payload), headers=self.headers)
-        return resp.json()
+    def add_message_to_room(self, room_id, message):
+        self.logger.info("In the Spark addMessageToRoom function. Adding to room ID %s", str(room_id))
+        uri = self.api_url + '/messages'
+        payload = {"roomId": room_id, "text": message}
+        return self.transport.post(uri, data=json.dumps(payload), headers=self.header, timeout=self.timeout)
 
     def send_sparkmsg(self, room_name, message):
         """Sends a note to the specified Spark Room
@@ -109,39 +264,58 @@ class CiscoSpark:
         Args:
             roomName: Name of the Cisco Spark Room to send to.
             message: body of the message
+
+        Returns:
+            True if the message was sent. Errors talking to Spark are
+            raised.
         """
         self.logger.info("Sending Cisco Spark message to %s: message = \"%s\"", room_name, message)
 
         if cfg.SPARK_ACCESSTOKEN == '':
             self.logger.error("Cisco Spark access token not specified - unable to send Spark message!")
 
-        self.logger.info("In the Spark block")
         self.header = self.headers()
-        self.rooms = self.get_rooms()
-        self.room_id = self.find_room(room_name)
-        if self.room_id != 0:
-            self.add_message_to_room(message)
-        else:
-            self.logger.info("Specified room %s was not found! Creating.", room_name)
-            self.add_room(room_name)
-            self.rooms = self.get_rooms()
-            self.room_id = self.find_room(room_name)
-            self.add_message_to_room(message)
+        with self.lock:
+            room_id = self.find_room(room_name)
+        resp = self.add_message_to_room(room_id, message)
+
+        if resp.status_code == 404:
+            # Room was deleted since it was cached - look it up again
+            self.logger.info("Cached room ID for %s is stale, refreshing", room_name)
+            with self.lock:
+                self.room_cache.pop(room_name, None)
+                room_id = self.find_room(room_name)
+            resp = self.add_message_to_room(room_id, message)
+
+        if resp.status_code == 429:
+            raise RateLimited(parse_retry_after(resp.headers.get('Retry-After')))
+        resp.raise_for_status()
+        return True
 
 ##############################################################################
 # Jabber support
 ##############################################################################
 
-class Jabber(sleekxmpp.ClientXMPP):
-    """Interfaces with a Jabber instant messaging service"""
+class Jabber:
+    """Interfaces with a Jabber instant messaging service
+
+    Connecting happens on a background thread so door monitoring can start
+    while the network is down. sleekxmpp retries the connection, and
+    reconnects if it drops later, with an exponential backoff capped at
+    cfg.JABBER_RETRY_MAX seconds. Messages sent while disconnected fail,
+    so they stay in the alert spool and are retried until the session is
+    back up.
+    """
 
-    def __init__(self, door_states, time_of_last_state_change):
+    def __init__(self, status_source):
         self.logger = logging.getLogger(__name__)
         self.connected = False
+        self.client = None
+        self.lock = threading.Lock()
 
-        # Save references to door states for status queries
-        self.door_states = door_states
-        self.time_of_last_state_change = time_of_last_state_change
+        # Object whose .snapshot is the latest StatusSnapshot, for status
+        # queries
+        self.status_source = status_source
 
         if not hasattr(cfg, 'JABBER_ID'):
             self.logger.debug("Jabber ID not defined - Jabber support disabled")
@@ -152,47 +326,60 @@ class Jabber(sleekxmpp.ClientXMPP):
 
         self.logger.info("Signing into Jabber as %s", cfg.JABBER_ID)
 
-        sleekxmpp.ClientXMPP.__init__(self, cfg.JABBER_ID, cfg.JABBER_PASSWORD)
+        import sleekxmpp
+        self.client = sleekxmpp.ClientXMPP(cfg.JABBER_ID, cfg.JABBER_PASSWORD)
 
         # Register event handlers
-        self.add_event_handler("session_start", self.handle_session_start)
-        self.add_event_handler("message", self.handle_message)
-        self.add_event_handler("ssl_invalid_cert", self.ssl_invalid_cert)
+        self.client.add_event_handler("session_start", self.handle_session_start)
+        self.client.add_event_handler("disconnected", self.handle_disconnected)
+        self.client.add_event_handler("message", self.handle_message)
+        self.client.add_event_handler("ssl_invalid_cert", self.ssl_invalid_cert)
 
-        # ctrl-c processing
-        self.use_signals()
+        # sleekxmpp's use_signals() isn't called: its SIGHUP and SIGTERM
+        # handlers would take over the daemon's own, which reload the
+        # config and shut down cleanly (disconnecting via terminate())
 
         # Setup plugins. Order does not matter.
-        self.register_plugin('xep_0030') # Service Discovery
-        self.register_plugin('xep_0004') # Data Forms
-        self.register_plugin('xep_0060') # PubSub
-        self.register_plugin('xep_0199') # XMPP Ping
+        self.client.register_plugin('xep_0030') # Service Discovery
+        self.client.register_plugin('xep_0004') # Data Forms
+        self.client.register_plugin('xep_0060') # PubSub
+        self.client.register_plugin('xep_0199') # XMPP Ping
 
         # If you are working with an OpenFire server, you may need
         # to adjust the SSL version used:
-        # self.ssl_version = ssl.PROTOCOL_SSLv3
+        # self.client.ssl_version = ssl.PROTOCOL_SSLv3
+
+        self.client.auto_reconnect = True
+        self.client.reconnect_max_delay = getattr(cfg, 'JABBER_RETRY_MAX', 300)
 
-        # Connect to the XMPP server and start processing XMPP stanzas.
-        # This will block if the network is down.
+        # Connecting blocks until the server is reachable, so do it in the
+        # background
+        threading.Thread(target=self.connect, name='jabber-connect', daemon=True).start()
 
+    def connect(self):
+        """Connect to the XMPP server and start processing XMPP stanzas.
+        This will block until the connection succeeds."""
         if hasattr(cfg, 'JABBER_SERVER') and hasattr(cfg, 'JABBER_PORT'):
             # Config file overrode the default server and port
-            if not self.connect((cfg.JABBER_SERVER, cfg.JABBER_PORT)): # pylint: disable=no-member
+            if not self.client.connect((cfg.JABBER_SERVER, cfg.JABBER_PORT)): # pylint: disable=no-member
+                self.logger.error("Unable to connect to Jabber server %s:%d", cfg.JABBER_SERVER, cfg.JABBER_PORT)
                 return
         else:
             # Use default server and port from DNS SRV records
-            if not self.connect():
+            if not self.client.connect():
+                self.logger.error("Unable to connect to Jabber server for %s", cfg.JABBER_ID)
                 return
 
         # Start up Jabber threads and return
-        self.process(block=False)
-        self.connected = True
+        self.client.process(block=False)
 
     def ssl_invalid_cert(self, raw_cert):
         """Handle an invalid certificate from the Jabber server
            This may happen if the domain is using Google Apps
            for their XMPP server and the XMPP server."""
-        hosts = resolver.get_SRV(self.boundjid.server, 5222,
+        from sleekxmpp.xmlstream import resolver, cert
+
+        hosts = resolver.get_SRV(self.client.boundjid.server, 5222,
                                  'xmpp-client',
                                  resolver=resolver.default_resolver())
 
@@ -204,13 +391,13 @@ class Jabber(sleekxmpp.ClientXMPP):
         if domain_uses_google:
             try:
                 if cert.verify('talk.google.com', ssl.PEM_cert_to_DER_cert(raw_cert)):
-                    logging.debug('Google certificate found for %s', self.boundjid.server)
+                    logging.debug('Google certificate found for %s', self.client.boundjid.server)
                     return
             except cert.CertificateError:
                 pass
 
-        logging.error("Invalid certificate received for %s", self.boundjid.server)
-        self.disconnect()
+        logging.error("Invalid certificate received for %s", self.client.boundjid.server)
+        self.client.disconnect()
 
     def handle_session_start(self, event):
         """Process the session_start event.
@@ -225,8 +412,22 @@ class Jabber(sleekxmpp.ClientXMPP):
                    data.
         """
         # pylint: disable=unused-argument
-        self.send_presence()
-        self.get_roster()
+        self.client.send_presence()
+        self.client.get_roster()
+
+        with self.lock:
+            self.connected = True
+        self.logger.info("Jabber session started")
+
+    def handle_disconnected(self, event):
+        """Process the disconnected event. sleekxmpp will try to
+        reconnect on its own."""
+        # pylint: disable=unused-argument
+        with self.lock:
+            was_connected = self.connected
+            self.connected = False
+        if was_connected:
+            self.logger.warning("Disconnected from Jabber, reconnecting")
 
     def handle_message(self, msg):
         """Process incoming message stanzas.
@@ -241,36 +442,105 @@ class Jabber(sleekxmpp.ClientXMPP):
         if msg['type'] in ('chat', 'normal') and hasattr(cfg, 'JABBER_AUTHORIZED_IDS'):
             # Check if user is authorized
             if msg['from'].bare in cfg.JABBER_AUTHORIZED_IDS:
-                if msg['body'].lower() == 'status':
+                command, _, args = msg['body'].strip().partition(' ')
+                command = command.lower()
+                history = getattr(self.status_source, 'history', None)
+                if command == 'status':
                     # Generate status report
                     states = []
-                    for door in cfg.GARAGE_DOORS:
-                        name = door['name']
-                        state = self.door_states[name]
-                        how_long = time.time() - self.time_of_last_state_change[name]
-                        states.append("%s: %s (%s)" % (name, state, format_duration(how_long)))
+                    for door in self.status_source.snapshot.doors:
+                        how_long = time.time() - door.since
+                        states.append("%s: %s (%s%s)" % (door.name, door.state, format_duration(how_long),
+                                                         ", flapping" if door.flapping else ""))
                     response = ' / '.join(states)
+                elif command in ('history', 'opentime', 'alerts') and history is not None:
+                    try:
+                        response = self.history_command(history, command, args)
+                    except ValueError:
+                        response = "Usage: %s [today|week|<number>h|<number>d] [door name]" % (command)
                 else:
                     # Invalid command received
                     response = "I don't understand that command. Valid commands are: status"
+                    if history is not None:
+                        response += ", history, opentime, alerts"
                 self.logger.info("Replied to %s: %s", msg['from'], response)
                 msg.reply(response).send()
             else:
                 self.logger.info("Ignored unauthorized user: %s", msg['from'].bare)
 
+    def history_command(self, history, command, args):
+        """Answer a query about the event history
+
+        Args:
+            history: HistoryStore to query
+            command: 'history' for recent state changes, 'opentime' for how
+                     long each door was open, or 'alerts' for alerts sent
+            args: Optional period, 'today', 'week' or a duration like 24h
+                  (default today), then an optional door name
+
+        Raises:
+            ValueError: The period is invalid
+        """
+        period, _, door_name = args.strip().partition(' ')
+        now = time.time()
+        if period in ('', 'today'):
+            start, description = local_midnight(now), "today"
+        elif period == 'week':
+            start, description = local_midnight(now, -6), "in the last week"
+        else:
+            start, description = now - parse_duration(period), "in the last %s" % (format_duration(parse_duration(period)).strip())
+
+        doors = [door.name for door in self.status_source.snapshot.doors]
+        if door_name:
+            doors = [name for name in doors if name.lower() == door_name.strip().lower()]
+            if not doors:
+                return "No door called %s" % (door_name)
+
+        if command == 'opentime':
+            results = []
+            for name in doors:
+                open_seconds, cycles = history.open_time(name, start, now)
+                results.append("%s: open %s, opened %d times" % (name, format_duration(open_seconds).strip(), cycles))
+            return "%s: %s" % (description.capitalize(), ' / '.join(results))
+
+        if command == 'history':
+            events = [event for event in history.events(start, now, limit=100) if event[0] in doors][-20:]
+            if not events:
+                return "No door changes %s" % (description)
+            return ' / '.join("%s %s %s" % (strftime('%a %H:%M', time.localtime(event_time)), name, state)
+                              for name, event_time, state in events)
+
+        count, alerts = history.alerts(start, now, limit=10)
+        if not alerts:
+            return "No alerts %s" % (description)
+        return "%d alerts %s, latest: %s" % (count, description,
+                                             ' / '.join("%s %s" % (strftime('%a %H:%M', time.localtime(alert_time)), msg)
+                                                        for _, alert_time, msg in alerts))
+
     def send_msg(self, recipient, msg):
-        """Send jabber message to specified recipient"""
-        if not self.connected:
-            self.logger.error("Unable to connect to Jabber - unable to send jabber message!")
-            return
+        """Send jabber message to specified recipient
+
+        Returns:
+            True if the message was sent, False if the session is down, in
+            which case the dispatcher retries it from the spool
+        """
+        if self.client is None:
+            self.logger.error("Jabber not configured - unable to send jabber message!")
+            return False
+
+        with self.lock:
+            if not self.connected:
+                self.logger.warning("Jabber not connected, unable to send message to %s yet", recipient)
+                return False
 
         self.logger.info("Sending Jabber message to %s: %s", recipient, msg)
-        self.send_message(mto=recipient, mbody=msg)
+        self.client.send_message(mto=recipient, mbody=msg)
+        return True
 
     def terminate(self):
         """Terminate all jabber threads"""
-        if self.connected:
-            self.disconnect()
+        if self.client is not None:
+            self.client.disconnect(reconnect=False, wait=False)
 
 ##############################################################################
 # Twilio support
@@ -289,6 +559,9 @@ class Twilio:
         Args:
             recipient: Phone number to send SMS to.
             msg: Message to send. Long messages will automatically be truncated.
+
+        Returns:
+            True if the SMS was sent
         """
 
         # User may not have configured twilio - don't initialize it until it's
@@ -299,20 +572,30 @@ class Twilio:
             if cfg.TWILIO_ACCOUNT == '' or cfg.TWILIO_TOKEN == '':
                 self.logger.error("Twilio account or token not specified - unable to send SMS!")
             else:
-                self.twilio_client = Client(cfg.TWILIO_ACCOUNT, cfg.TWILIO_TOKEN)
+                from twilio.rest import Client
+                from twilio.http.http_client import TwilioHttpClient
+
+                http_client = TwilioHttpClient(timeout=channel_timeout('Twilio'))
+                self.twilio_client = Client(cfg.TWILIO_ACCOUNT, cfg.TWILIO_TOKEN, http_client=http_client)
 
         if self.twilio_client is not None:
+            from twilio.base.exceptions import TwilioRestException
+
             self.logger.info("Sending SMS to %s: %s", recipient, msg)
             try:
                 self.twilio_client.messages.create(
                     to=recipient,
                     from_=cfg.TWILIO_PHONE_NUMBER,
                     body=truncate(msg, 140))
+                return True
             except TwilioRestException as ex:
+                raise_if_rate_limited(ex)
                 self.logger.error("Unable to send SMS: %s", ex)
             except Exception as ex:
                 self.logger.error("Exception sending SMS: %s %s", ex, sys.exc_info()[0])
 
+        return False
+
 ##############################################################################
 # Twitter support
 ##############################################################################
@@ -341,9 +624,11 @@ class Twitter:
             elif cfg.TWITTER_ACCESS_KEY == '' or cfg.TWITTER_ACCESS_SECRET == '':
                 self.logger.error("Twitter access key/secret not specified - unable to Tweet!")
             else:
+                import tweepy
+
                 auth = tweepy.OAuthHandler(cfg.TWITTER_CONSUMER_KEY, cfg.TWITTER_CONSUMER_SECRET)
                 auth.set_access_token(cfg.TWITTER_ACCESS_KEY, cfg.TWITTER_ACCESS_SECRET)
-                self.twitter_api = tweepy.API(auth)
+                self.twitter_api = tweepy.API(auth, timeout=channel_timeout('Twitter'))
 
     def direct_msg(self, user, msg):
         """Send direct message to specified Twitter user.
@@ -351,73 +636,155 @@ class Twitter:
         Args:
             user: User to send DM to.
             msg: Message to send. Long messages will automatically be truncated.
+
+        Returns:
+            True if the DM was sent
         """
 
         self.connect()
 
         if self.twitter_api is not None:
+            import tweepy
+
             # Twitter doesn't like the same msg sent over and over, so add a timestamp
             msg = strftime("%Y-%m-%d %H:%M:%S: ") + msg
 
             self.logger.info("Sending twitter DM to %s: %s", user, msg)
             try:
                 self.twitter_api.send_direct_message(recipient_id=user, text=truncate(msg, 140))
+                return True
             except tweepy.error.TweepError as ex:
+                raise_if_rate_limited(ex)
                 self.logger.error("Unable to send Tweet: %s", ex)
 
+        return False
+
     def update_status(self, msg):
         """Update the users's status
 
         Args:
             msg: New status to set. Long messages will automatically be truncated.
+
+        Returns:
+            True if the status was updated
         """
 
         self.connect()
 
         if self.twitter_api is not None:
+            import tweepy
+
             # Twitter doesn't like the same msg sent over and over, so add a timestamp
             msg = strftime("%Y-%m-%d %H:%M:%S: ") + msg
 
             self.logger.info("Updating Twitter status to: %s", msg)
             try:
                 self.twitter_api.update_status(status=truncate(msg, 140))
+                return True
             except tweepy.error.TweepError as ex:
+                raise_if_rate_limited(ex)
                 self.logger.error("Unable to update Twitter status: %s", ex)
 
+        return False
+
 ##############################################################################
 # Email support
 ##############################################################################
 
 class Email:
-    """Class to send emails"""
+    """Class to send emails
+
+    The SMTP connection is kept open between sends and reopened if the
+    server has dropped it, so an alert only pays for the TCP, TLS and
+    login handshakes when the connection has gone away.
+    """
 
     def __init__(self):
         self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.mail = None
+        self.last_used = 0
+
+    def connect(self):
+        """Returns an authenticated SMTP connection, reusing the open one if
+        it hasn't been idle for longer than cfg.SMTP_IDLE_TIMEOUT"""
+        if self.mail is not None:
+            if time.monotonic() - self.last_used < getattr(cfg, 'SMTP_IDLE_TIMEOUT', 60):
+                return self.mail
+            self.close()
+
+        timeout = channel_timeout('Email')
+        security = getattr(cfg, 'SMTP_SECURITY', '')
+        if security == 'ssl':
+            mail = smtplib.SMTP_SSL(cfg.SMTP_SERVER, cfg.SMTP_PORT, timeout=timeout,
+                                    context=ssl.create_default_context())
+        else:
+            mail = smtplib.SMTP(cfg.SMTP_SERVER, cfg.SMTP_PORT, timeout=timeout)
+            if security == 'starttls':
+                mail.starttls(context=ssl.create_default_context())
+        if cfg.SMTP_USER != '' and cfg.SMTP_PASS != '':
+            mail.login(cfg.SMTP_USER, cfg.SMTP_PASS)
+
+        self.mail = mail
+        return mail
+
+    def close(self):
+        """Close the SMTP connection, if open"""
+        if self.mail is not None:
+            try:
+                self.mail.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.mail = None
+
+    def terminate(self):
+        """Close the SMTP connection"""
+        with self.lock:
+            self.close()
 
-    def send_email(self, recipient, subject, msg):
-        """Sends an email to the specified email address.
+    def send_email(self, recipients, subject, msg):
+        """Sends an email to the specified email addresses in one transaction.
 
         Args:
-            recipient: Email address to send to.
+            recipients: Email address or list of addresses to send to.
             subject: Email subject.
             msg: Body of email to send.
+
+        Returns:
+            True if the email was sent
         """
-        self.logger.info("Sending email to %s: subject = \"%s\", message = \"%s\"", recipient, subject, msg)
+        if isinstance(recipients, str):
+            recipients = [recipients]
+
+        self.logger.info("Sending email to %s: subject = \"%s\", message = \"%s\"", ', '.join(recipients), subject, msg)
 
         msg = MIMEText(msg)
         msg['Subject'] = subject
-        msg['To'] = recipient
+        msg['To'] = ', '.join(recipients)
         msg['From'] = cfg.EMAIL_FROM
         msg['X-Priority'] = cfg.EMAIL_PRIORITY
 
-        try:
-            mail = smtplib.SMTP(cfg.SMTP_SERVER, cfg.SMTP_PORT)
-            if cfg.SMTP_USER != '' and cfg.SMTP_PASS != '':
-                mail.login(cfg.SMTP_USER, cfg.SMTP_PASS)
-            mail.sendmail(cfg.EMAIL_FROM, recipient, msg.as_string())
-            mail.quit()
-        except:
-            self.logger.error("Exception sending email: %s", sys.exc_info()[0])
+        with self.lock:
+            # If the kept-alive connection has gone stale, reconnect and
+            # try once more
+            for attempt in range(2):
+                try:
+                    refused = self.connect().sendmail(cfg.EMAIL_FROM, recipients, msg.as_string())
+                    self.last_used = time.monotonic()
+                    for recipient, error in refused.items():
+                        self.logger.error("Email to %s refused: %s", recipient, error)
+                    return True
+                except (smtplib.SMTPServerDisconnected, ConnectionError) as ex:
+                    self.mail = None
+                    if attempt == 0:
+                        self.logger.info("SMTP connection lost (%s), reconnecting", ex)
+                except:
+                    self.logger.error("Exception sending email: %s", sys.exc_info()[0])
+                    self.close()
+                    return False
+
+        self.logger.error("Unable to send email: SMTP server disconnected")
+        return False
 
 ##############################################################################
 # Pushbullet support
@@ -426,8 +793,11 @@ class Email:
 class Pushbullet:
     """Class to send Pushbullet notes"""
 
-    def __init__(self):
+    def __init__(self, transport):
         self.logger = logging.getLogger(__name__)
+        self.transport = transport
+        self.timeout = channel_timeout('Pushbullet', transport.timeout)
+        self.url = getattr(cfg, 'PUSHBULLET_URL', 'https://api.pushbullet.com/v2/pushes')
 
     def send_note(self, access_token, title, body):
         """Sends a note to the specified access token.
@@ -436,6 +806,9 @@ class Pushbullet:
             access_token: Access token of the Pushbullet account to send to.
             title: Note title
             body: Body of the note to send
+
+        Returns:
+            True if the note was sent
         """
         self.logger.info("Sending Pushbullet note to %s: title = \"%s\", body = \"%s\"", access_token, title, body)
 
@@ -443,12 +816,14 @@ class Pushbullet:
         payload = {'type': 'note', 'title': title, 'body': body}
 
         try:
-            session = requests.Session()
-            session.auth = (access_token, "")
-            session.headers.update(headers)
-            session.post("https://api.pushbullet.com/v2/pushes", data=json.dumps(payload))
+            resp = self.transport.post(self.url, auth=(access_token, ""),
+                                       headers=headers, data=json.dumps(payload), timeout=self.timeout)
+            resp.raise_for_status()
+            return True
         except:
+            raise_if_rate_limited(sys.exc_info()[1])
             self.logger.error("Exception sending note: %s", sys.exc_info()[0])
+            return False
 
 ##############################################################################
 # IFTTT support using Maker Channel (https://ifttt.com/maker)
@@ -457,8 +832,11 @@ class Pushbullet:
 class IFTTT:
     """Class to send IFTTT triggers using the Maker Channel"""
 
-    def __init__(self):
+    def __init__(self, transport):
         self.logger = logging.getLogger(__name__)
+        self.transport = transport
+        self.timeout = channel_timeout('IFTTT', transport.timeout)
+        self.url = getattr(cfg, 'IFTTT_URL', 'https://maker.ifttt.com')
 
     def send_trigger(self, event, value1, value2, value3):
         """Send an IFTTT event using the maker channel.
@@ -468,15 +846,22 @@ class IFTTT:
         Args:
             event: Event name
             value1, value2, value3: Optional data to supply to IFTTT.
+
+        Returns:
+            True if the event was sent
         """
         self.logger.info("Sending IFTTT event \"%s\": value1 = \"%s\", value2 = \"%s\", value3 = \"%s\"", event, value1, value2, value3)
 
         headers = {'Content-type': 'application/json'}
         payload = {'value1': value1, 'value2': value2, 'value3': value3}
         try:
-            requests.post("https://maker.ifttt.com/trigger/%s/with/key/%s" % (event, cfg.IFTTT_KEY), headers=headers, data=json.dumps(payload))
+            resp = self.transport.post("%s/trigger/%s/with/key/%s" % (self.url, event, cfg.IFTTT_KEY), headers=headers, data=json.dumps(payload), timeout=self.timeout)
+            resp.raise_for_status()
+            return True
         except:
+            raise_if_rate_limited(sys.exc_info()[1])
             self.logger.error("Exception sending IFTTT event: %s", sys.exc_info()[0])
+            return False
 
 ##############################################################################
 # Google Cloud Messaging support
@@ -485,8 +870,11 @@ class IFTTT:
 class GoogleCloudMessaging:
     """Class to send GCM notifications"""
 
-    def __init__(self):
+    def __init__(self, transport):
         self.logger = logging.getLogger(__name__)
+        self.transport = transport
+        self.timeout = channel_timeout('Gcm', transport.timeout)
+        self.url = getattr(cfg, 'GCM_URL', 'https://gcm-http.googleapis.com/gcm/send')
 
     def send_push(self, state, body):
         """Sends a push notification to the specified topic.
@@ -494,6 +882,9 @@ class GoogleCloudMessaging:
         Args:
             state: Garage door state as string ("0"|"1")
             body: Body of the note to send
+
+        Returns:
+            True if the push was sent
         """
         status = "1" if state == 'open' else "0"
 
@@ -504,11 +895,13 @@ class GoogleCloudMessaging:
         payload = {'to': cfg.GCM_TOPIC, 'data': {'message': body, 'status': status}}
 
         try:
-            session = requests.Session()
-            session.headers.update(headers)
-            session.post("https://gcm-http.googleapis.com/gcm/send", data=json.dumps(payload))
+            resp = self.transport.post(self.url, headers=headers, data=json.dumps(payload), timeout=self.timeout)
+            resp.raise_for_status()
+            return True
         except:
+            raise_if_rate_limited(sys.exc_info()[1])
             self.logger.error("Exception sending push: %s", sys.exc_info()[0])
+            return False
 
 ##############################################################################
 # Slack support
@@ -527,7 +920,10 @@ class Slack:
 
     def __init__(self):
         if cfg.SLACK_BOT_TOKEN:
-            self.slack_client = slack.WebClient(cfg.SLACK_BOT_TOKEN)
+            import slack
+
+            self.slack_client = slack.WebClient(cfg.SLACK_BOT_TOKEN, timeout=channel_timeout('Slack'),
+                                                base_url=getattr(cfg, 'SLACK_API_URL', 'https://www.slack.com/api/'))
         else:
             self.slack_client = None
         self.logger = logging.getLogger(__name__)
@@ -538,40 +934,268 @@ class Slack:
             channel: Channel ID to send to
             state: Garage door state as string
             body: Body of the note to send
+
+        Returns:
+            True if the message was sent
         """
         if self.slack_client:
             self.logger.info("Sending Slack Message: state = \"%s\", body = \"%s\"", state, body)
             try:
                 self.slack_client.api_call("chat.postMessage", json={'channel': channel, 'text': body})
+                return True
             except:
+                raise_if_rate_limited(sys.exc_info()[1])
                 self.logger.error("Exception sending slack message: %s", sys.exc_info()[0])
         else:
             self.logger.error('Slack bot token not configured - unable to send message to Slack channel')
 
+        return False
+
 ##############################################################################
 # Sensor support
 ##############################################################################
 
-def get_garage_door_state(pin):
-    """Returns the state of the garage door on the specified pin as a string
+class SensorBackend:
+    """Interface to the hardware the door sensors are wired to
 
-    Args:
-        pin: GPIO pin number.
+    Backends read many inputs in one call so that hardware which can read
+    a whole port at once only needs one bus transaction per cycle. A
+    reading is True when the circuit is open, i.e. the door is open.
     """
-    if GPIO.input(pin): # pylint: disable=no-member
-        state = 'open'
-    else:
-        state = 'closed'
 
-    return state
+    # Whether add_edge_callback() is supported
+    supports_edges = False
+
+    def setup(self, pins):
+        """Configure the given inputs"""
+
+    def read(self, pins):
+        """Read the given inputs
+
+        Returns:
+            Dict of pin to True if the input is high (door open)
+        """
+        raise NotImplementedError
+
+    def add_edge_callback(self, pins, callback):
+        """Call callback(pin) from another thread whenever one of the
+        inputs changes level"""
+        raise NotImplementedError
+
+    def cleanup(self):
+        """Release the hardware"""
+
+class RPiGpioBackend(SensorBackend):
+    """Sensors wired directly to the Raspberry Pi GPIO header, numbered by
+    board pin, with the internal pull up resistors enabled"""
+
+    supports_edges = True
+
+    def __init__(self):
+        import RPi.GPIO
+        self.gpio = RPi.GPIO
+
+    def setup(self, pins):
+        self.gpio.setmode(self.gpio.BOARD)
+        for pin in pins:
+            self.gpio.setup(pin, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+
+    def read(self, pins):
+        return {pin: bool(self.gpio.input(pin)) for pin in pins} # pylint: disable=no-member
+
+    def add_edge_callback(self, pins, callback):
+        for pin in pins:
+            self.gpio.add_event_detect(pin, self.gpio.BOTH, callback=callback) # pylint: disable=no-member
+
+    def cleanup(self):
+        self.gpio.cleanup() # pylint: disable=no-member
+
+class Mcp23017Backend(SensorBackend):
+    """Sensors wired to MCP23017 I2C port expanders
+
+    Pins 0-15 are GPA0-GPA7 and GPB0-GPB7 of the first expander in
+    cfg.SENSOR_I2C_ADDRESSES, pins 16-31 the second, and so on. Both ports
+    of an expander are read with a single I2C block read.
+    """
+
+    IODIRA = 0x00
+    GPPUA = 0x0C
+    GPIOA = 0x12
+
+    def __init__(self):
+        import smbus
+        self.bus = smbus.SMBus(getattr(cfg, 'SENSOR_I2C_BUS', 1))
+        self.addresses = getattr(cfg, 'SENSOR_I2C_ADDRESSES', [0x20])
+
+    def setup(self, pins):
+        for expander in {pin // 16 for pin in pins}:
+            address = self.addresses[expander]
+            # All inputs, with pull ups
+            self.bus.write_i2c_block_data(address, self.IODIRA, [0xff, 0xff])
+            self.bus.write_i2c_block_data(address, self.GPPUA, [0xff, 0xff])
+
+    def read(self, pins):
+        ports = dict()
+        for expander in {pin // 16 for pin in pins}:
+            port_a, port_b = self.bus.read_i2c_block_data(self.addresses[expander], self.GPIOA, 2)
+            ports[expander] = port_a | (port_b << 8)
+        return {pin: bool(ports[pin // 16] & (1 << (pin % 16))) for pin in pins}
+
+class SimulatedBackend(SensorBackend):
+    """Software sensors for running without any hardware
+
+    Inputs start closed. If cfg.SENSOR_SIMULATION_FILENAME is set, the file
+    is replayed in the background. Each line is "<seconds> <pin> <state>",
+    where seconds is the time since startup and state is open or closed.
+    Blank lines and lines starting with # are ignored.
+    """
+
+    supports_edges = True
+
+    def __init__(self, filename=None):
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.levels = dict()
+        self.callback = None
+        self.events = []
+        if filename:
+            self.events = self.load(filename)
+
+    @staticmethod
+    def load(filename):
+        """Returns the (seconds, pin, level) events in a simulation file"""
+        events = []
+        with open(filename, 'r') as script:
+            for line_number, line in enumerate(script, 1):
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+                try:
+                    seconds, pin, state = line.split()
+                    if state not in ('open', 'closed'):
+                        raise ValueError(state)
+                    events.append((float(seconds), int(pin), state == 'open'))
+                except ValueError:
+                    raise ConfigError("Invalid line %d in %s: %s" % (line_number, filename, line))
+        return sorted(events)
+
+    def setup(self, pins):
+        with self.lock:
+            for pin in pins:
+                self.levels.setdefault(pin, False)
+        if self.events:
+            threading.Thread(target=self.replay, name='sensor-sim', daemon=True).start()
+
+    def replay(self):
+        """Apply the scripted events at their times"""
+        start = time.monotonic()
+        for seconds, pin, level in self.events:
+            time.sleep(max(start + seconds - time.monotonic(), 0))
+            self.set_level(pin, level)
+
+    def set_level(self, pin, level):
+        """Change the level of an input, as if the door had moved"""
+        with self.lock:
+            changed = self.levels.get(pin) != level
+            self.levels[pin] = level
+        if changed and self.callback is not None:
+            self.callback(pin)
+
+    def read(self, pins):
+        with self.lock:
+            return {pin: self.levels.get(pin, False) for pin in pins}
+
+    def add_edge_callback(self, pins, callback):
+        self.callback = callback
+
+def create_sensor_backend():
+    """Returns the SensorBackend selected by cfg.SENSOR_BACKEND"""
+    backend = getattr(cfg, 'SENSOR_BACKEND', 'rpi')
+    if backend == 'rpi':
+        return RPiGpioBackend()
+    if backend == 'mcp23017':
+        return Mcp23017Backend()
+    if backend == 'simulated':
+        return SimulatedBackend(getattr(cfg, 'SENSOR_SIMULATION_FILENAME', None))
+    raise ConfigError("Unknown sensor backend: %s" % (backend))
+
+class EdgeMonitor:
+    """Wakes up the main loop when a sensor pin changes level
+
+    Uses the sensor backend's edge callbacks instead of polling. Bouncing contacts are
+    handled in software: once an edge arrives, wait() doesn't return until
+    the pins have been quiet for the debounce period, so the level read
+    afterwards is the settled one.
+    """
+
+    def __init__(self, backend, pins, debounce_ms):
+        self.logger = logging.getLogger(__name__)
+        self.debounce = debounce_ms / 1000.0
+        self.cond = threading.Condition()
+        self.pending = set()
+        self.last_edge = 0
+        self.woken = False
+
+        self.backend = backend
+        self.pins = set()
+        self.watch(pins)
+
+    def watch(self, pins):
+        """Start watching more pins. Pins already watched are skipped."""
+        pins = [pin for pin in pins if pin not in self.pins]
+        if pins:
+            self.backend.add_edge_callback(pins, self.handle_edge)
+            self.pins.update(pins)
+
+    def handle_edge(self, pin):
+        """Called from the backend's callback thread on every edge"""
+        with self.cond:
+            self.pending.add(pin)
+            self.last_edge = time.monotonic()
+            self.cond.notify()
+
+    def wake(self):
+        """Makes wait() return early, so the main loop looks at other work"""
+        with self.cond:
+            self.woken = True
+            self.cond.notify()
+
+    def wait(self, timeout):
+        """Wait for sensor edges.
+
+        Args:
+            timeout: Maximum number of seconds to wait
+
+        Returns:
+            Set of pins which saw an edge, which may be empty on timeout
+            or wake()
+        """
+        with self.cond:
+            if not self.pending and not self.woken:
+                self.cond.wait(max(timeout, 0))
+            self.woken = False
+
+            # Debounce - wait until the pins have settled
+            while self.pending:
+                quiet_for = time.monotonic() - self.last_edge
+                if quiet_for >= self.debounce:
+                    break
+                self.cond.wait(self.debounce - quiet_for)
+
+            pins = self.pending
+            self.pending = set()
+        return pins
+
+def get_uptime_seconds():
+    """Returns the uptime of the RPi in seconds
+    """
+    with open('/proc/uptime', 'r') as uptime_file:
+        return float(uptime_file.readline().split()[0])
 
 def get_uptime():
     """Returns the uptime of the RPi as a string
     """
-    with open('/proc/uptime', 'r') as uptime_file:
-        uptime_seconds = int(float(uptime_file.readline().split()[0]))
-        uptime_string = str(timedelta(seconds=uptime_seconds))
-    return uptime_string
+    return str(timedelta(seconds=int(get_uptime_seconds())))
 
 def get_gpu_temp():
     """Return the GPU temperature as a Celsius float
@@ -598,47 +1222,1261 @@ def get_cpu_temp():
 
     return cpu_temp
 
-def rpi_status():
+def rpi_health():
+    """Return dict with the RPi's 'cpu_temp' and 'gpu_temp' in Celsius and
+    'uptime' in seconds. Readings which aren't available are None.
+    """
+    health = dict()
+    for key, reading in (('cpu_temp', get_cpu_temp), ('gpu_temp', get_gpu_temp), ('uptime', get_uptime_seconds)):
+        try:
+            health[key] = reading()
+        except (OSError, ValueError):
+            health[key] = None
+    return health
+
+def rpi_status(health=None):
     """Return string summarizing RPi status
+
+    Args:
+        health: Readings from rpi_health(), taken now if not given
+    """
+    if health is None:
+        health = rpi_health()
+
+    def format_temp(temp):
+        return 'unknown' if temp is None else '%.1f' % (temp)
+
+    uptime = 'unknown' if health.get('uptime') is None else str(timedelta(seconds=int(health['uptime'])))
+    return "CPU temp: %s, GPU temp: %s, Uptime: %s" % (format_temp(health.get('cpu_temp')), format_temp(health.get('gpu_temp')), uptime)
+
+##############################################################################
+# Health monitoring
+##############################################################################
+
+# One set of health readings, taken at time.time() time
+HealthSample = collections.namedtuple('HealthSample', 'time cpu_temp gpu_temp uptime')
+
+class HealthSampler:
+    """Samples the RPi's health on a background thread
+
+    The procfs and sysfs files are opened once and re-read with pread(),
+    and the GPU temperature is read through the VideoCore mailbox rather
+    than by running vcgencmd, falling back to vcgencmd only if the mailbox
+    can't be used. The GPU is sampled less often than the rest. The last
+    history readings are kept in a ring buffer for trend data.
+    """
+
+    THERMAL_ZONE = '/sys/class/thermal/thermal_zone0/temp'
+
+    # Mailbox property interface tag for the SoC temperature, and the
+    # ioctl to send a property request: _IOWR(100, 0, char *)
+    MAILBOX_DEVICE = '/dev/vcio'
+    TAG_GET_TEMPERATURE = 0x00030006
+    IOCTL_MBOX_PROPERTY = 0xc0006400 | (struct.calcsize('P') << 16)
+
+    def __init__(self, interval=10, gpu_interval=60, history=360):
+        self.logger = logging.getLogger(__name__)
+        self.interval = interval
+        self.gpu_interval = gpu_interval
+        self.lock = threading.Lock()
+        self.history = collections.deque(maxlen=history)
+        self.stopped = threading.Event()
+        self.thread = None
+
+        # Latest readings as a dict like rpi_health() returns. Replaced,
+        # never modified.
+        self.latest = {'cpu_temp': None, 'gpu_temp': None, 'uptime': None}
+
+        self.fds = dict()
+        for key, filename in (('cpu_temp', self.THERMAL_ZONE), ('uptime', '/proc/uptime'),
+                              ('mailbox', self.MAILBOX_DEVICE)):
+            try:
+                self.fds[key] = os.open(filename, os.O_RDONLY)
+            except OSError:
+                pass
+        self.gpu_temp = None
+        self.next_gpu_sample = 0
+
+    def start(self):
+        """Take the first sample, then keep sampling in the background"""
+        self.sample()
+        self.thread = threading.Thread(target=self.run, name='health', daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        """Sampling thread body"""
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def read_fd(self, key):
+        """Re-read one of the open files from the start"""
+        return os.pread(self.fds[key], 64, 0).decode('ascii')
+
+    def read_mailbox_temp(self):
+        """Returns the SoC temperature reported by the VideoCore firmware"""
+        # Buffer size, request code, tag, value buffer size, tag request
+        # code, temperature ID, value, end tag
+        request = array.array('I', [32, 0, self.TAG_GET_TEMPERATURE, 8, 0, 0, 0, 0])
+        fcntl.ioctl(self.fds['mailbox'], self.IOCTL_MBOX_PROPERTY, request, True)
+        if request[1] != 0x80000000:
+            raise OSError("Mailbox request failed: 0x%x" % (request[1]))
+        return request[6] / 1000.0
+
+    def read_gpu_temp(self):
+        """Returns the GPU temperature, preferring the mailbox to vcgencmd"""
+        if 'mailbox' in self.fds:
+            try:
+                return self.read_mailbox_temp()
+            except OSError as ex:
+                self.logger.info("Unable to read GPU temperature from %s, using vcgencmd: %s", self.MAILBOX_DEVICE, ex)
+                os.close(self.fds.pop('mailbox'))
+        return get_gpu_temp()
+
+    def sample(self):
+        """Take one set of readings"""
+        readings = dict()
+        for key, read in (('cpu_temp', lambda: float(self.read_fd('cpu_temp')) / 1000.0),
+                          ('uptime', lambda: float(self.read_fd('uptime').split()[0]))):
+            try:
+                readings[key] = read()
+            except (KeyError, OSError, ValueError, IndexError):
+                readings[key] = None
+
+        now = time.monotonic()
+        if self.gpu_interval and now >= self.next_gpu_sample:
+            self.next_gpu_sample = now + self.gpu_interval
+            try:
+                self.gpu_temp = self.read_gpu_temp()
+            except (OSError, ValueError):
+                self.gpu_temp = None
+        readings['gpu_temp'] = self.gpu_temp
+
+        self.latest = readings
+        with self.lock:
+            self.history.append(HealthSample(time.time(), readings['cpu_temp'], readings['gpu_temp'], readings['uptime']))
+
+    def recent(self):
+        """Returns the readings in the ring buffer, oldest first"""
+        with self.lock:
+            return list(self.history)
+
+    def stop(self):
+        """Stop sampling and close the files"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = dict()
+
+class HealthAlert:
+    """A threshold on one health reading, with hysteresis: it fires when
+    the reading goes above above, and clears once it's back below
+    clear_below"""
+
+    __slots__ = ('reading', 'above', 'clear_below', 'routes', 'active')
+
+    def __init__(self, reading, above, clear_below, routes):
+        self.reading = reading
+        self.above = above
+        self.clear_below = clear_below
+        self.routes = routes
+        self.active = False
+
+##############################################################################
+# Alert spool
+##############################################################################
+
+# Send counters and latency totals (in seconds) for one channel. queued is
+# the number of sends currently held back by rate limits, dropped the
+# number given up on because too many were held back, and rate_limited the
+# number of 429 responses.
+ChannelStats = collections.namedtuple('ChannelStats', 'sent failed skipped latency_sum latency_max '
+                                      'queued dropped rate_limited')
+
+class SpooledAlert:
+    """A single send waiting in the alert spool"""
+
+    __slots__ = ('spool_id', 'channel', 'method', 'args', 'created', 'attempts', 'next_attempt')
+
+    def __init__(self, spool_id, channel, method, args, created, attempts=0, next_attempt=0):
+        self.spool_id = spool_id
+        self.channel = channel
+        self.method = method
+        self.args = args
+        self.created = created
+        self.attempts = attempts
+        self.next_attempt = next_attempt
+
+class AlertSpool:
+    """Crash-safe record of alerts which haven't been delivered yet
+
+    Every send is written to an SQLite database in WAL mode before it is
+    attempted and deleted once it succeeds, so alerts survive network
+    outages and daemon restarts. WAL mode with synchronous=NORMAL keeps
+    each write to a small append to the log instead of rewriting pages of
+    the database on the SD card.
+    """
+
+    def __init__(self, filename):
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+
+        if filename:
+            os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        else:
+            # Still retry failed sends, just not across restarts
+            filename = ':memory:'
+
+        self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            # auto_vacuum only takes effect if set before the table is created
+            self.db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS spool ('
+                            'id INTEGER PRIMARY KEY, channel TEXT, method TEXT, args TEXT, '
+                            'created REAL, attempts INTEGER, next_attempt REAL)')
+
+    def add(self, channel, method, args):
+        """Record a new send
+
+        Returns:
+            SpooledAlert for the send
+        """
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute('INSERT INTO spool (channel, method, args, created, attempts, next_attempt) '
+                                     'VALUES (?, ?, ?, ?, 0, ?)',
+                                     (channel, method, json.dumps(args, separators=(',', ':')), now, now))
+        return SpooledAlert(cursor.lastrowid, channel, method, args, now, 0, now)
+
+    def pending(self):
+        """Returns a list of every SpooledAlert still waiting to be delivered"""
+        with self.lock:
+            rows = self.db.execute('SELECT id, channel, method, args, created, attempts, next_attempt '
+                                   'FROM spool ORDER BY id').fetchall()
+        return [SpooledAlert(row[0], row[1], row[2], tuple(json.loads(row[3])), row[4], row[5], row[6])
+                for row in rows]
+
+    def done(self, job):
+        """Remove a send from the spool"""
+        with self.lock:
+            self.db.execute('DELETE FROM spool WHERE id = ?', (job.spool_id,))
+
+    def retry_later(self, job):
+        """Save the attempt count and next attempt time of a failed send"""
+        with self.lock:
+            self.db.execute('UPDATE spool SET attempts = ?, next_attempt = ? WHERE id = ?',
+                            (job.attempts, job.next_attempt, job.spool_id))
+
+    def compact(self):
+        """Fold the WAL back into the database and release free pages"""
+        with self.lock:
+            self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.db.execute('PRAGMA incremental_vacuum')
+
+    def close(self):
+        """Close the database"""
+        with self.lock:
+            self.db.close()
+
+##############################################################################
+# Rate limiting
+##############################################################################
+
+class RateLimited(Exception):
+    """Raised by a sender when the service has asked it to slow down
+
+    Args:
+        retry_after: Seconds the service asked us to wait, if it said
+    """
+
+    def __init__(self, retry_after=None):
+        super().__init__("Rate limited, retry after %s sec" % (retry_after))
+        self.retry_after = retry_after
+
+def parse_retry_after(value):
+    """Returns the seconds to wait from a Retry-After header, which may be
+    a number of seconds or an HTTP date, or None if it's missing or invalid"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def raise_if_rate_limited(ex):
+    """Re-raise an exception from a service SDK as RateLimited if it was a
+    429 response
+
+    Works with requests, slackclient and tweepy errors, which carry the
+    response, and Twilio errors, which carry the status.
+    """
+    response = getattr(ex, 'response', None)
+    status = getattr(response, 'status_code', getattr(ex, 'status', None))
+    if status == 429:
+        headers = getattr(response, 'headers', None) or {}
+        raise RateLimited(parse_retry_after(headers.get('Retry-After')))
+
+class TokenBucket:
+    """Limits sends to rate per second on average, with bursts of up to
+    burst sends
+
+    A bucket with no rate never runs out, but can still be paused, e.g.
+    when a service sends Retry-After. Not thread safe; AlertDispatcher
+    only uses buckets with its lock held.
     """
-    return "CPU temp: %.1f, GPU temp: %.1f, Uptime: %s" % (get_gpu_temp(), get_cpu_temp(), get_uptime())
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def delay(self, now):
+        """Returns how many seconds until a send may be made, 0 if now"""
+        delay = max(self.paused_until - now, 0)
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                delay = max(delay, (1 - self.tokens) / self.rate)
+        return delay
+
+    def take(self):
+        """Use up a token. Only call after delay() has returned 0."""
+        if self.rate:
+            self.tokens -= 1
+
+    def pause(self, until):
+        """Allow no sends until the monotonic time until"""
+        self.paused_until = max(self.paused_until, until)
+
+##############################################################################
+# Circuit breakers
+##############################################################################
+
+class CircuitBreaker:
+    """Stops sending to a channel that keeps failing
+
+    After failure_threshold consecutive failures the breaker opens and
+    sends are skipped without touching the network. Once reset_timeout
+    seconds have passed a single probe send is let through: if it
+    succeeds the breaker closes again, otherwise it stays open for
+    another reset_timeout.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.skipped = 0
+
+    def allow(self):
+        """Returns True if a send may be attempted now"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Let one probe through
+                self.state = self.HALF_OPEN
+                return True
+            self.skipped += 1
+            return False
+
+    def retry_delay(self):
+        """Returns the number of seconds until the next probe will be allowed"""
+        with self.lock:
+            return max(self.opened_at + self.reset_timeout - time.monotonic(), 0)
+
+    def record_success(self):
+        """Note a successful send"""
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def release_probe(self):
+        """Note that a send let through by allow() didn't show whether the
+        service is up, e.g. because it was rate limited. A probe goes back
+        to open, so the next send can probe again."""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_failure(self):
+        """Note a failed send
+
+        Returns:
+            True if this failure opened the breaker
+        """
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                tripped = self.state == self.CLOSED
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                return tripped
+            return False
 
 ##############################################################################
 # Logging and alerts
 ##############################################################################
 
-def send_alerts(logger, alert_senders, recipients, subject, msg, state, time_in_state):
-    """Send subject and msg to specified recipients
+class AlertDispatcher:
+    """Fans alerts out to a bounded pool of worker threads
+
+    Each channel (Email, Twilio, ...) may only have a limited number of
+    sends in flight at once so a single slow service can't tie up every
+    worker. Sends over the limit wait in a per-channel backlog and are
+    picked up by the worker that finishes the previous send.
+
+    Sends are recorded in an AlertSpool first. A send that fails is retried
+    with exponential backoff and jitter by a separate retry thread until it
+    succeeds or is older than max_age seconds.
+
+    Each channel also has a CircuitBreaker. While a channel's breaker is
+    open its sends are skipped and put back in the retry queue, so a dead
+    service costs nothing but the skip.
+
+    Sends can be rate limited with a TokenBucket per channel and per
+    recipient. A send with no token available waits in the retry queue
+    until one is, so a burst of alerts goes out at the provider's allowed
+    rate instead of failing. A 429 response pauses the channel for as long
+    as the service asked. If more than max_queued sends of a channel are
+    waiting, further ones are dropped.
+    """
+
+    def __init__(self, alert_senders, spool, max_workers=4, channel_limits=None, default_limit=2,
+                 retry_min=5, retry_max=600, max_age=86400, compact_interval=3600,
+                 breaker_threshold=5, breaker_reset=60, rate_limits=None, recipient_rate_limits=None,
+                 max_queued=1000, recipient_of=None):
+        self.logger = logging.getLogger(__name__)
+        self.senders = alert_senders
+        self.spool = spool
+        self.channel_limits = channel_limits or {}
+        self.default_limit = default_limit
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.max_age = max_age
+        self.compact_interval = compact_interval
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                              thread_name_prefix='alert')
+        self.lock = threading.Lock()
+        self.active = collections.Counter()
+        self.backlog = collections.defaultdict(collections.deque)
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.breakers = {channel: CircuitBreaker(breaker_threshold, breaker_reset) for channel in alert_senders}
+
+        # Rate limits, as channel -> (sends per second, burst). Recipient
+        # buckets are created as recipients are first seen.
+        self.rate_limits = rate_limits = rate_limits or {}
+        self.channel_buckets = {channel: TokenBucket(*rate_limits.get(channel, (None, 1))) for channel in alert_senders}
+        self.recipient_rate_limits = recipient_rate_limits or {}
+        self.recipient_buckets = dict()
+        self.recipient_of = recipient_of
+        self.max_queued = max_queued
+
+        # Spool IDs of the sends of each channel held back by rate limits
+        self.rate_waiting = collections.defaultdict(set)
+
+        # Per-channel ChannelStats. Replaced, never modified, so readers
+        # on other threads always see a consistent copy.
+        self.channel_stats = {channel: ChannelStats(0, 0, 0, 0.0, 0.0, 0, 0, 0) for channel in alert_senders}
+
+        # Heap of (next_attempt, spool_id, job) for sends waiting to be retried
+        self.retry_cond = threading.Condition()
+        self.retry_heap = []
+        self.running = True
+
+        # Pick up anything left over from before a restart
+        pending = spool.pending()
+        if pending:
+            self.logger.info("Resuming delivery of %d spooled alerts", len(pending))
+        for job in pending:
+            self.schedule_retry(job)
+
+        self.retry_thread = threading.Thread(target=self.retry_loop, name='alert-retry', daemon=True)
+        self.retry_thread.start()
+
+    def channel_limit(self, channel):
+        """Returns the maximum number of concurrent sends for a channel"""
+        return max(1, self.channel_limits.get(channel, self.default_limit))
+
+    def submit(self, channel, method, *args):
+        """Spool a send and return immediately.
+
+        Args:
+            channel: Key of the sender in alert_senders
+            method: Name of the sender method to call
+            args: Arguments to pass to the sender method
+        """
+        self.enqueue(self.spool.add(channel, method, args))
+
+    def enqueue(self, job):
+        """Hand a spooled send to a worker, or the channel backlog if the
+        channel is already at its concurrency limit"""
+        with self.lock:
+            if self.active[job.channel] >= self.channel_limit(job.channel):
+                self.backlog[job.channel].append(job)
+                return
+            self.active[job.channel] += 1
+        self.executor.submit(self.run, job)
+
+    def run(self, job):
+        """Worker body. Sends the job, then drains the channel backlog."""
+        channel = job.channel
+        while job is not None:
+            self.deliver(job)
+
+            with self.lock:
+                if self.backlog[channel]:
+                    job = self.backlog[channel].popleft()
+                else:
+                    self.active[channel] -= 1
+                    job = None
+
+    def deliver(self, job):
+        """Attempt a send and update the spool with the outcome"""
+        sender = self.senders.get(job.channel)
+        if sender is None:
+            # Spooled by an earlier run whose config used this channel
+            self.logger.error("No %s sender configured, dropping alert: %s", job.channel, job.args)
+            self.spool.done(job)
+            return
+
+        # Rate limits first, so a send held back by them is never let
+        # through the breaker as a probe
+        delay = self.take_tokens(job)
+        if delay > 0:
+            self.hold(job, delay)
+            return
+
+        breaker = self.breakers[job.channel]
+        if not breaker.allow():
+            # Channel is down - don't count this as an attempt, just try
+            # again when the breaker is ready for a probe
+            job.next_attempt = time.time() + max(breaker.retry_delay(), self.retry_min)
+            self.spool.retry_later(job)
+            self.schedule_retry(job)
+            self.record_stats(job.channel, skipped=True)
+            return
+
+        start = time.monotonic()
+        try:
+            # Senders return False on failure. Anything else, including
+            # None from senders that don't report, counts as delivered.
+            delivered = getattr(sender, job.method)(*job.args) is not False
+        except RateLimited as ex:
+            # Not the service failing, so don't count it against the breaker
+            delay = self.retry_min if ex.retry_after is None else ex.retry_after
+            self.logger.warning("%s is rate limiting us, pausing sends for %.1f sec", job.channel, delay)
+            breaker.release_probe()
+            with self.lock:
+                self.channel_buckets[job.channel].pause(time.monotonic() + delay)
+            self.record_stats(job.channel, rate_limited=True, latency=time.monotonic() - start)
+            self.hold(job, delay)
+            return
+        except Exception:
+            self.logger.error("Exception sending %s alert: %s", job.channel, traceback.format_exc())
+            delivered = False
+        self.record_stats(job.channel, delivered=delivered, latency=time.monotonic() - start)
+
+        if delivered:
+            breaker.record_success()
+            self.spool.done(job)
+            return
+
+        if breaker.record_failure():
+            self.logger.error("%s has failed %d times in a row, pausing sends for %d sec",
+                              job.channel, breaker.failures, breaker.reset_timeout)
+
+        job.attempts += 1
+        if time.time() - job.created > self.max_age:
+            self.logger.error("Giving up on %s alert after %d attempts: %s", job.channel, job.attempts, job.args)
+            self.spool.done(job)
+            return
+
+        delay = min(self.retry_max, self.retry_min * 2 ** (job.attempts - 1))
+        delay = random.uniform(delay / 2, delay)
+        job.next_attempt = time.time() + delay
+        self.logger.warning("%s alert failed (attempt %d), retrying in %.1f sec", job.channel, job.attempts, delay)
+        self.spool.retry_later(job)
+        self.schedule_retry(job)
+
+    def take_tokens(self, job):
+        """Take a token from the channel's and the recipient's buckets, if
+        both have one
+
+        Returns:
+            0 if the send may go ahead, otherwise seconds until it may
+        """
+        with self.lock:
+            now = time.monotonic()
+            buckets = [self.channel_buckets[job.channel]]
+            recipient = self.recipient_of(job.channel, job.method, job.args) if self.recipient_of else None
+            if recipient is not None and job.channel in self.recipient_rate_limits:
+                bucket = self.recipient_buckets.get((job.channel, recipient))
+                if bucket is None:
+                    bucket = TokenBucket(*self.recipient_rate_limits[job.channel])
+                    self.recipient_buckets[(job.channel, recipient)] = bucket
+                buckets.append(bucket)
+
+            delay = max(bucket.delay(now) for bucket in buckets)
+            if delay <= 0:
+                for bucket in buckets:
+                    bucket.take()
+                self.rate_waiting[job.channel].discard(job.spool_id)
+            return delay
+
+    def hold(self, job, delay):
+        """Put a rate limited send back in the retry queue for delay
+        seconds, or drop it if too many are waiting already"""
+        with self.lock:
+            waiting = self.rate_waiting[job.channel]
+            dropped = job.spool_id not in waiting and len(waiting) >= self.max_queued
+            if not dropped:
+                waiting.add(job.spool_id)
+
+        if dropped:
+            self.logger.error("Too many %s alerts held back by rate limits, dropping: %s", job.channel, job.args)
+            self.spool.done(job)
+            self.record_stats(job.channel, dropped=True)
+            return
+
+        job.next_attempt = time.time() + delay
+        self.schedule_retry(job)
+        self.record_stats(job.channel)
+
+    def record_stats(self, channel, delivered=False, skipped=False, latency=None, dropped=False, rate_limited=False):
+        """Publish updated ChannelStats for a channel"""
+        with self.lock:
+            stats = self.channel_stats[channel]
+            if skipped:
+                stats = stats._replace(skipped=stats.skipped + 1)
+            elif dropped:
+                stats = stats._replace(dropped=stats.dropped + 1)
+            elif latency is not None:
+                stats = stats._replace(sent=stats.sent + (1 if delivered else 0),
+                                       failed=stats.failed + (0 if delivered or rate_limited else 1),
+                                       rate_limited=stats.rate_limited + (1 if rate_limited else 0),
+                                       latency_sum=stats.latency_sum + latency,
+                                       latency_max=max(stats.latency_max, latency))
+            stats = stats._replace(queued=len(self.rate_waiting[channel]))
+            channel_stats = dict(self.channel_stats)
+            channel_stats[channel] = stats
+            self.channel_stats = channel_stats
+
+    def schedule_retry(self, job):
+        """Queue a send to be retried at job.next_attempt"""
+        with self.retry_cond:
+            heapq.heappush(self.retry_heap, (job.next_attempt, job.spool_id, job))
+            self.retry_cond.notify()
+
+    def retry_loop(self):
+        """Retry thread body. Requeues sends as they fall due and
+        periodically compacts the spool."""
+        next_compact = time.time() + self.compact_interval
+        while True:
+            with self.retry_cond:
+                if not self.running:
+                    return
+
+                timeout = next_compact - time.time()
+                if self.retry_heap:
+                    timeout = min(timeout, self.retry_heap[0][0] - time.time())
+                if timeout > 0:
+                    self.retry_cond.wait(timeout)
+                if not self.running:
+                    return
+
+                due = []
+                while self.retry_heap and self.retry_heap[0][0] <= time.time():
+                    due.append(heapq.heappop(self.retry_heap)[2])
+
+            for job in due:
+                self.enqueue(job)
+
+            if time.time() >= next_compact:
+                self.spool.compact()
+                next_compact = time.time() + self.compact_interval
+
+    def update_senders(self, alert_senders, channel_limits=None, rate_limits=None, recipient_rate_limits=None):
+        """Switch to a new set of senders and limits after a config reload
+
+        Channels that were already configured keep their circuit breakers,
+        stats and, unless their rate limit changed, their token buckets.
+        Sends spooled for channels that are no longer configured are
+        dropped as they come up.
+        """
+        rate_limits = rate_limits or {}
+        recipient_rate_limits = recipient_rate_limits or {}
+        with self.lock:
+            # Replaced rather than modified, as other threads iterate over them
+            breakers = dict(self.breakers)
+            channel_buckets = dict(self.channel_buckets)
+            channel_stats = dict(self.channel_stats)
+            for channel in alert_senders:
+                if channel not in breakers:
+                    breakers[channel] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+                    channel_stats[channel] = ChannelStats(0, 0, 0, 0.0, 0.0, 0, 0, 0)
+                limit = rate_limits.get(channel, (None, 1))
+                if channel not in channel_buckets or self.rate_limits.get(channel, (None, 1)) != limit:
+                    channel_buckets[channel] = TokenBucket(*limit)
+            if recipient_rate_limits != self.recipient_rate_limits:
+                self.recipient_buckets = dict()
+
+            self.breakers = breakers
+            self.channel_buckets = channel_buckets
+            self.channel_stats = channel_stats
+            self.rate_limits = rate_limits
+            self.recipient_rate_limits = recipient_rate_limits
+            self.channel_limits = channel_limits or {}
+            self.senders = alert_senders
+
+    def open_circuits(self):
+        """Returns a list of (channel, skipped sends) for each channel whose
+        circuit breaker isn't closed"""
+        return [(channel, breaker.skipped) for channel, breaker in sorted(self.breakers.items())
+                if breaker.state != CircuitBreaker.CLOSED]
+
+    def shutdown(self):
+        """Wait for in-flight sends to finish and stop the worker threads.
+        Sends waiting to be retried stay in the spool for the next run."""
+        with self.retry_cond:
+            self.running = False
+            self.retry_cond.notify()
+        self.retry_thread.join()
+        self.executor.shutdown(wait=True)
+        self.spool.close()
+
+##############################################################################
+# Recipient routing
+##############################################################################
+
+class ConfigError(Exception):
+    """Raised when the configuration file is invalid"""
+
+# An alert on its way to the senders. kind is 'door' for a door's alert
+# ladder and state changes, which digests can shorten to "Door open 10 min",
+# and 'notice' for anything else, whose msg is always sent as is.
+Alert = collections.namedtuple('Alert', 'subject msg state time_in_state kind', defaults=('notice',))
+
+class ChannelSpec:
+    """How to create the sender for a channel"""
+
+    __slots__ = ('name', 'factory', 'modules', 'broadcast_methods', 'settings')
+
+    def __init__(self, name, factory, modules, broadcast_methods, settings):
+        self.name = name
+        self.factory = factory
+        self.modules = modules
+        self.broadcast_methods = broadcast_methods
+        self.settings = settings
+
+class RecipientType:
+    """How to send an alert to one type of recipient, e.g. 'sms'"""
+
+    __slots__ = ('name', 'channel', 'build', 'has_address')
+
+    def __init__(self, name, channel, build, has_address):
+        self.name = name
+        self.channel = channel
+        self.build = build
+        self.has_address = has_address
+
+class SenderRegistry:
+    """Registry of alert channels and the recipient types they handle
+
+    Recipients in the config are strings of the form type:address, or just
+    type for types without an address. The registry turns each alert's
+    recipient list into routes once at startup, so sending an alert is a
+    walk over the routes with no string parsing.
+
+    Third party channels can be added by listing modules in
+    cfg.SENDER_PLUGINS. Each module must have a register(registry)
+    function which calls add_channel() and add_recipient_type().
+    """
+
+    def __init__(self):
+        self.channels = dict()
+        self.recipient_types = dict()
+
+    def add_channel(self, name, factory, modules=(), broadcast_methods=(), settings=()):
+        """Register a channel.
+
+        Args:
+            name: Channel name, e.g. 'Email'
+            factory: Function taking the PiGarageAlert instance and
+                     returning the sender object
+            modules: Modules to import before calling factory. They are
+                     only imported if the channel is used.
+            broadcast_methods: Sender methods that don't send to a
+                               particular recipient. The first argument
+                               of every other method is the recipient.
+            settings: Prefixes of the config settings the sender is
+                      created from, e.g. 'SMTP_'. The sender is created
+                      again if any of them change on a config reload.
+        """
+        self.channels[name] = ChannelSpec(name, factory, list(modules), frozenset(broadcast_methods),
+                                          tuple(settings))
+
+    def add_recipient_type(self, name, channel, build, has_address=True):
+        """Register a recipient type.
+
+        Args:
+            name: Recipient type, the part of the recipient before the colon
+            channel: Name of the channel which sends to this type
+            build: Function taking a tuple of addresses and an Alert, and
+                   returning a list of (sender method name, args) to call
+            has_address: False if recipients of this type are just the
+                         type name, like 'tweet'
+        """
+        self.recipient_types[name] = RecipientType(name, channel, build, has_address)
+
+    def recipient(self, channel, method, args):
+        """Returns a string identifying the recipient of a send, or None if
+        it isn't sent to a particular recipient"""
+        spec = self.channels.get(channel)
+        if spec is None or method in spec.broadcast_methods or not args:
+            return None
+        return json.dumps(args[0])
+
+    def load_plugins(self, module_names):
+        """Import sender plugin modules and let them register themselves"""
+        for module_name in module_names:
+            importlib.import_module(module_name).register(self)
+
+    def parse(self, recipient):
+        """Split a recipient string into its RecipientType and address
+
+        Raises:
+            ConfigError: The recipient type is unknown or malformed
+        """
+        if not isinstance(recipient, str):
+            raise ConfigError("Recipient must be a string: %r" % (recipient,))
+        name, _, address = recipient.partition(':')
+        recipient_type = self.recipient_types.get(name)
+        if recipient_type is None or recipient_type.channel not in self.channels:
+            raise ConfigError("Unrecognized recipient type: %s" % (recipient))
+        if recipient_type.has_address and address == '':
+            raise ConfigError("Recipient %s has no address" % (recipient))
+        if not recipient_type.has_address and address != '':
+            raise ConfigError("Recipient %s doesn't take an address" % (recipient))
+        return recipient_type, address
+
+    def compile(self, recipients):
+        """Turn a list of recipient strings into routes
+
+        Returns:
+            Tuple of (RecipientType, tuple of addresses), one per recipient
+            type, in the order the types first appear in recipients
+
+        Raises:
+            ConfigError: A recipient is invalid
+        """
+        if not isinstance(recipients, (list, tuple)):
+            raise ConfigError("Recipients must be a list: %r" % (recipients,))
+        routes = dict()
+        for recipient in recipients:
+            recipient_type, address = self.parse(recipient)
+            addresses = routes.setdefault(recipient_type, [])
+            if address not in addresses:
+                addresses.append(address)
+        return tuple((recipient_type, tuple(addresses)) for recipient_type, addresses in routes.items())
+
+SENDERS = SenderRegistry()
+
+SENDERS.add_channel('Email', lambda app: Email(), settings=['SMTP_', 'EMAIL_'])
+SENDERS.add_channel('Twitter', lambda app: Twitter(), ['tweepy'], ['update_status'], ['TWITTER_'])
+SENDERS.add_channel('Twilio', lambda app: Twilio(), ['twilio.rest', 'twilio.http.http_client'], settings=['TWILIO_'])
+SENDERS.add_channel('Jabber', lambda app: Jabber(app), ['sleekxmpp'],
+                    settings=['JABBER_ID', 'JABBER_PASSWORD', 'JABBER_SERVER', 'JABBER_PORT'])
+SENDERS.add_channel('Pushbullet', lambda app: Pushbullet(app.get_transport()), ['requests'], settings=['PUSHBULLET_'])
+SENDERS.add_channel('IFTTT', lambda app: IFTTT(app.get_transport()), ['requests'], settings=['IFTTT_'])
+SENDERS.add_channel('CiscoSpark', lambda app: CiscoSpark(app.get_transport()), ['requests'], settings=['SPARK_'])
+SENDERS.add_channel('Gcm', lambda app: GoogleCloudMessaging(app.get_transport()), ['requests'], ['send_push'],
+                    ['GCM_'])
+SENDERS.add_channel('Slack', lambda app: Slack(), ['slack'], settings=['SLACK_'])
+
+# All email recipients get one message, sent in a single SMTP transaction
+SENDERS.add_recipient_type('email', 'Email',
+                           lambda addresses, alert: [('send_email', (list(addresses), alert.subject, alert.msg))])
+SENDERS.add_recipient_type('twitter_dm', 'Twitter',
+                           lambda addresses, alert: [('direct_msg', (address, alert.msg)) for address in addresses])
+SENDERS.add_recipient_type('tweet', 'Twitter',
+                           lambda addresses, alert: [('update_status', (alert.msg,))], has_address=False)
+SENDERS.add_recipient_type('sms', 'Twilio',
+                           lambda addresses, alert: [('send_sms', (address, alert.msg)) for address in addresses])
+SENDERS.add_recipient_type('jabber', 'Jabber',
+                           lambda addresses, alert: [('send_msg', (address, alert.msg)) for address in addresses])
+SENDERS.add_recipient_type('pushbullet', 'Pushbullet',
+                           lambda addresses, alert: [('send_note', (address, alert.subject, alert.msg)) for address in addresses])
+SENDERS.add_recipient_type('ifttt', 'IFTTT',
+                           lambda addresses, alert: [('send_trigger', (address, alert.subject, alert.state, '%d' % (alert.time_in_state)))
+                                                     for address in addresses])
+SENDERS.add_recipient_type('spark', 'CiscoSpark',
+                           lambda addresses, alert: [('send_sparkmsg', (address, alert.msg)) for address in addresses])
+SENDERS.add_recipient_type('gcm', 'Gcm',
+                           lambda addresses, alert: [('send_push', (alert.state, alert.msg))], has_address=False)
+SENDERS.add_recipient_type('slack', 'Slack',
+                           lambda addresses, alert: [('send_message', (address, alert.state, alert.msg)) for address in addresses])
+
+def compile_doors(doors):
+    """Compile the recipients of every alert of every door
+
+    Args:
+        doors: cfg.GARAGE_DOORS
+
+    Returns:
+        Dict of door name to a list with the routes of each of its alerts
+
+    Raises:
+        ConfigError: A door or alert is invalid
+    """
+    if not isinstance(doors, (list, tuple)):
+        raise ConfigError("GARAGE_DOORS must be a list of doors")
+
+    door_routes = dict()
+    for door in doors:
+        if not isinstance(door, dict):
+            raise ConfigError("Every door must be a dict: %r" % (door,))
+        name = door.get('name')
+        if not isinstance(name, str) or not name:
+            raise ConfigError("Every door needs a name: %s" % (door))
+        if name in door_routes:
+            raise ConfigError("Door name \"%s\" is used more than once" % (name))
+        if not isinstance(door.get('pin'), int) or isinstance(door['pin'], bool) or door['pin'] < 0:
+            raise ConfigError("Pin for \"%s\" must be a pin number: %s" % (name, door))
+        if not isinstance(door.get('alerts'), (list, tuple)):
+            raise ConfigError("Alerts for \"%s\" must be a list, which may be empty: %s" % (name, door))
+
+        door_routes[name] = []
+        for alert in door['alerts']:
+            if not isinstance(alert, dict):
+                raise ConfigError("Every alert for \"%s\" must be a dict: %r" % (name, alert))
+            if alert.get('state') not in ('open', 'closed'):
+                raise ConfigError("Alert state for \"%s\" must be 'open' or 'closed': %s" % (name, alert))
+            if not isinstance(alert.get('time'), (int, float)) or isinstance(alert['time'], bool) or alert['time'] < 0:
+                raise ConfigError("Alert time for \"%s\" must be a number of seconds: %s" % (name, alert))
+            if 'recipients' not in alert:
+                raise ConfigError("Alert for \"%s\" has no recipients: %s" % (name, alert))
+            try:
+                door_routes[name].append(SENDERS.compile(alert['recipients']))
+            except ConfigError as ex:
+                raise ConfigError("%s (door \"%s\")" % (ex, name))
+    return door_routes
+
+# Health readings that can have alerts, and what to call them in messages
+HEALTH_READINGS = {'cpu_temp': 'CPU temperature', 'gpu_temp': 'GPU temperature'}
+
+def compile_health_alerts(health_alerts):
+    """Compile cfg.HEALTH_ALERTS
+
+    Returns:
+        List of HealthAlert
+
+    Raises:
+        ConfigError: An alert is invalid
+    """
+    compiled = []
+    for alert in health_alerts:
+        if alert.get('reading') not in HEALTH_READINGS:
+            raise ConfigError("Health alert reading must be one of %s: %s" % (', '.join(sorted(HEALTH_READINGS)), alert))
+        if not isinstance(alert.get('above'), (int, float)):
+            raise ConfigError("Health alert needs a number to go 'above': %s" % (alert))
+        clear_below = alert.get('clear_below', alert['above'] - 5)
+        if not isinstance(clear_below, (int, float)) or clear_below > alert['above']:
+            raise ConfigError("Health alert 'clear_below' must be a number no more than 'above': %s" % (alert))
+        compiled.append(HealthAlert(alert['reading'], alert['above'], clear_below,
+                                    SENDERS.compile(alert.get('recipients', []))))
+    return compiled
+
+def configured_channels(door_routes, health_alerts=()):
+    """Returns the set of channels used by the compiled routes of the doors
+    and health alerts"""
+    channels = set()
+    for alert_routes in door_routes.values():
+        for routes in alert_routes:
+            channels.update(recipient_type.channel for recipient_type, _ in routes)
+    for health_alert in health_alerts:
+        channels.update(recipient_type.channel for recipient_type, _ in health_alert.routes)
+
+    # Jabber also answers status queries, even if no alerts go to it
+    if getattr(cfg, 'JABBER_ID', ''):
+        channels.add('Jabber')
+
+    return channels
+
+def send_alerts(dispatcher, routes, subject, msg, state, time_in_state, kind='notice'):
+    """Queue subject and msg for delivery to the specified recipients
+
+    The sends themselves happen on the dispatcher's worker threads, so
+    this returns without waiting for any network I/O.
 
     Args:
-        recipients: An array of strings of the form type:address
+        dispatcher: AlertDispatcher to queue the sends on
+        routes: Recipients compiled by SenderRegistry.compile()
         subject: Subject of the alert
         msg: Body of the alert
         state: The state of the door
+        time_in_state: Seconds the door has been in that state
+        kind: Alert kind, 'door' or 'notice'
     """
-    for recipient in recipients:
-        if recipient[:6] == 'email:':
-            alert_senders['Email'].send_email(recipient[6:], subject, msg)
-        elif recipient[:11] == 'twitter_dm:':
-            alert_senders['Twitter'].direct_msg(recipient[11:], msg)
-        elif recipient == 'tweet':
-            alert_senders['Twitter'].update_status(msg)
-        elif recipient[:4] == 'sms:':
-            alert_senders['Twilio'].send_sms(recipient[4:], msg)
-        elif recipient[:7] == 'jabber:':
-            alert_senders['Jabber'].send_msg(recipient[7:], msg)
-        elif recipient[:11] == 'pushbullet:':
-            alert_senders['Pushbullet'].send_note(recipient[11:], subject, msg)
-        elif recipient[:6] == 'ifttt:':
-            alert_senders['IFTTT'].send_trigger(recipient[6:], subject, state, '%d' % (time_in_state))
-        elif recipient[:6] == 'spark:':
-            alert_senders['CiscoSpark'].send_sparkmsg(recipient[6:], msg)
-        elif recipient == 'gcm':
-            alert_senders['Gcm'].send_push(state, msg)
-        elif recipient[:6] == 'slack:':
-            alert_senders['Slack'].send_message(recipient[6:], state, msg)
-        else:
-            logger.error("Unrecognized recipient type: %s", recipient)
+    alert = Alert(subject, msg, state, time_in_state, kind)
+    for recipient_type, addresses in routes:
+        for method, args in recipient_type.build(addresses, alert):
+            dispatcher.submit(recipient_type.channel, method, *args)
+
+def short_duration(duration_sec):
+    """Format a duration compactly for digests, e.g. 12 min"""
+    for unit, seconds in (('day', 86400), ('hr', 3600), ('min', 60)):
+        if duration_sec >= seconds:
+            return "%d %s" % (duration_sec // seconds, unit)
+    return "%d sec" % (duration_sec)
+
+class AlertCoalescer:
+    """Combines the alerts each recipient gets within a short window
+
+    The first alert for a recipient starts the window; when it closes, a
+    recipient with a single pending alert gets it unchanged and one with
+    several gets one digest, e.g. "Door 1 open 10 min, Door 3 open 12 min".
+    Only door alerts are shortened like this; other notices, such as
+    health alerts, go into the digest whole. Recipients who are due the
+    same alerts are still sent them together, so email keeps going out as
+    one message.
+
+    Alerts are only spooled once the window closes, so any still held
+    here are lost if the daemon dies before then.
+    """
+
+    def __init__(self, dispatcher, scheduler, clock, window):
+        self.logger = logging.getLogger(__name__)
+        self.dispatcher = dispatcher
+        self.scheduler = scheduler
+        self.clock = clock
+        self.window = window
+
+        # RecipientType -> address -> list of pending Alerts, in arrival order
+        self.pending = collections.OrderedDict()
+
+    def add(self, routes, alert):
+        """Hold an alert for the recipients in routes until the window closes"""
+        if not self.pending:
+            self.scheduler.schedule(('coalesce',), self.clock.monotonic() + self.window, self.flush)
+        for recipient_type, addresses in routes:
+            pending = self.pending.setdefault(recipient_type, collections.OrderedDict())
+            for address in addresses:
+                pending.setdefault(address, []).append(alert)
+
+    @staticmethod
+    def digest(alerts):
+        """Returns a single Alert summarizing alerts"""
+        if len(alerts) == 1:
+            return alerts[0]
+
+        parts = []
+        for alert in alerts:
+            if alert.kind != 'door':
+                parts.append(alert.msg)
+            elif alert.time_in_state:
+                parts.append("%s %s %s" % (alert.subject, alert.state, short_duration(alert.time_in_state)))
+            else:
+                parts.append("%s now %s" % (alert.subject, alert.state))
+        subjects = list(collections.OrderedDict.fromkeys(alert.subject for alert in alerts))
+        states = set(alert.state for alert in alerts)
+        return Alert(', '.join(subjects), ', '.join(parts),
+                     'open' if 'open' in states else alerts[-1].state,
+                     max(alert.time_in_state for alert in alerts))
+
+    def flush(self):
+        """Send everything pending now"""
+        self.scheduler.cancel(('coalesce',))
+        pending, self.pending = self.pending, collections.OrderedDict()
+        received = sent = 0
+        for recipient_type, alerts_by_address in pending.items():
+            # Group addresses due exactly the same alerts
+            groups = collections.OrderedDict()
+            for address, alerts in alerts_by_address.items():
+                groups.setdefault(tuple(alerts), []).append(address)
+                received += len(alerts)
+            for alerts, addresses in groups.items():
+                for method, args in recipient_type.build(tuple(addresses), self.digest(alerts)):
+                    self.dispatcher.submit(recipient_type.channel, method, *args)
+                    sent += 1
+        if sent < received:
+            self.logger.info("Coalesced alerts to %d recipients into %d sends", received, sent)
+
+##############################################################################
+# Config reloading
+##############################################################################
+
+# Settings which are only read at startup. Changes to these are logged, but
+# only take effect when the daemon is restarted.
+RESTART_SETTINGS = ('SENSOR_', 'SENDER_PLUGINS', 'STATE_FILENAME', 'HISTORY_FILENAME', 'STATUS_HTTP_',
+                    'HEALTH_SAMPLE_INTERVAL', 'HEALTH_GPU_INTERVAL', 'HEALTH_HISTORY', 'LOG_',
+                    'ALERT_WORKERS', 'SPOOL_', 'CIRCUIT_BREAKER_', 'RATE_LIMIT_MAX_QUEUED', 'HTTP_',
+                    'CONFIG_', 'JABBER_RETRY_MAX')
+
+def config_settings(module):
+    """Returns a dict of the settings in a config module"""
+    return {name: value for name, value in vars(module).items()
+            if name.isupper() and not name.startswith('_')}
+
+def load_config(filename):
+    """Load a config file into a new module, leaving cfg alone
+
+    The source is compiled directly rather than imported, so a stale
+    cached bytecode file can never be picked up instead.
+
+    Raises:
+        ConfigError: The file couldn't be read or failed to run
+    """
+    module = types.ModuleType(cfg.__name__)
+    module.__file__ = filename
+    try:
+        with open(filename) as config_file:
+            code = compile(config_file.read(), filename, 'exec')
+        exec(code, vars(module))
+    except Exception as ex:
+        raise ConfigError("Can't load %s: %s" % (filename, ex))
+    return module
+
+def check_reloadable_settings(module):
+    """Check the settings other than the doors and health alerts which a
+    reload applies straight away
+
+    Raises:
+        ConfigError: A setting is invalid
+    """
+    for name in ('ALERT_COALESCE_WINDOW', 'FLAP_WINDOW', 'FLAP_THRESHOLD', 'FLAP_QUIET'):
+        value = getattr(module, name, 0)
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise ConfigError("%s must be a number: %r" % (name, value))
+    for name in ('RATE_LIMITS', 'RECIPIENT_RATE_LIMITS'):
+        limits = getattr(module, name, {})
+        if not isinstance(limits, dict) or not all(isinstance(limit, (list, tuple)) and len(limit) == 2
+                                                   for limit in limits.values()):
+            raise ConfigError("%s must map channels to (sends per second, burst): %r" % (name, limits))
+    for name in ('CHANNEL_TIMEOUTS', 'ALERT_CHANNEL_CONCURRENCY'):
+        if not isinstance(getattr(module, name, {}), dict):
+            raise ConfigError("%s must be a dict of channel settings" % (name))
+
+class ConfigWatcher:
+    """Notices when the config file has been written
+
+    Uses inotify on the file's directory, so editors which save by
+    renaming a new file over the old one are caught too. Where inotify
+    isn't available it falls back to comparing the file's mtime, size
+    and inode on each check. Either way changed() never blocks; with
+    inotify, start() waits for changes on a thread instead.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = os.O_CLOEXEC
+
+    # struct inotify_event, without the variable length name
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, filename):
+        self.logger = logging.getLogger(__name__)
+        self.filename = os.path.abspath(filename)
+        self.name = os.path.basename(self.filename).encode()
+        self.fd = None
+        self.stamp = self.file_stamp()
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            if libc.inotify_add_watch(fd, os.path.dirname(self.filename).encode(),
+                                      self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, "inotify_add_watch failed")
+            self.fd = fd
+        except (OSError, AttributeError) as ex:
+            self.logger.info("Can't watch %s with inotify, checking its mtime instead: %s", self.filename, ex)
+
+    def file_stamp(self):
+        """Returns something which changes whenever the file is rewritten"""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def events(self):
+        """Returns the names of the files in the directory written since
+        the last call"""
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                names.add(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+
+    def changed(self):
+        """Returns True if the file has changed since the last call"""
+        if self.fd is not None and self.name not in self.events():
+            return False
+        stamp = self.file_stamp()
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        return True
+
+    def start(self, callback):
+        """Call callback from a background thread whenever the file
+        changes, so nothing needs to poll changed()
+
+        Returns:
+            False if inotify isn't available and changed() must be polled
+        """
+        if self.fd is None:
+            return False
+        threading.Thread(target=self.run, args=(callback,), name='config-watcher', daemon=True).start()
+        return True
+
+    def run(self, callback):
+        """Watcher thread. Ends when close() closes the inotify fd."""
+        while True:
+            try:
+                select.select([self.fd], [], [])
+                if self.changed():
+                    callback()
+            except (OSError, ValueError, TypeError):
+                return
+
+    def close(self):
+        """Stop watching the file"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
 
 ##############################################################################
 # Misc support
@@ -656,6 +2494,15 @@ def truncate(input_str, length):
 
     return input_str[:(length - 3)] + '...'
 
+def channel_timeout(channel, default=15):
+    """Returns the network timeout in seconds for a channel
+
+    Args:
+        channel: Sender name, e.g. 'Email'
+        default: Timeout to use if cfg.CHANNEL_TIMEOUTS doesn't list the channel
+    """
+    return getattr(cfg, 'CHANNEL_TIMEOUTS', {}).get(channel, default)
+
 def format_duration(duration_sec):
     """Format a duration into a human friendly string"""
     days, remainder = divmod(duration_sec, 86400)
@@ -684,132 +2531,1660 @@ def format_duration(duration_sec):
     return ret
 
 
+##############################################################################
+# Event history
+##############################################################################
+
+def local_midnight(timestamp, days=0):
+    """Returns the time.time() of local midnight at the start of the day
+    timestamp falls in, plus days days"""
+    day = time.localtime(timestamp)
+    return time.mktime((day.tm_year, day.tm_mon, day.tm_mday + days, 0, 0, 0, 0, 0, -1))
+
+class HistoryStore:
+    """Long term record of door state changes and alerts
+
+    Everything is kept in an SQLite database, with the events of each door
+    clustered by time so range queries are index scans. A daily rollup of
+    each door's open time and number of openings is maintained as events
+    are written, so queries over long periods mostly just add up one row
+    per day.
+
+    Writes are queued and made in batches on a background thread, so
+    recording an event never waits on the SD card. Queries are answered
+    on the caller's thread through a separate connection.
+    """
+
+    def __init__(self, filename):
+        self.logger = logging.getLogger(__name__)
+        if filename != ':memory:':
+            os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        self.filename = filename
+
+        self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS doors (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS events (door INTEGER, time REAL, open INTEGER, '
+                        'PRIMARY KEY (door, time)) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS alerts (door INTEGER, time REAL, msg TEXT, recipients TEXT, '
+                        'PRIMARY KEY (door, time, msg)) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS daily (door INTEGER, day REAL, open_seconds REAL, cycles INTEGER, '
+                        'PRIMARY KEY (door, day)) WITHOUT ROWID')
+
+        # Door name -> ID, and door ID -> (time, open) of its latest event
+        self.door_ids = {name: door_id for door_id, name in self.db.execute('SELECT id, name FROM doors')}
+        self.last_events = {door_id: (event_time, bool(is_open)) for door_id, event_time, is_open in self.db.execute(
+            'SELECT door, MAX(time), open FROM events GROUP BY door')}
+
+        # Queries use their own connection so they don't wait for the
+        # writer's transactions. An in-memory database can't be shared,
+        # so that just has the one.
+        if filename == ':memory:':
+            self.reader = self.db
+        else:
+            self.reader = sqlite3.connect(filename, check_same_thread=False)
+        self.read_lock = threading.Lock()
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='history', daemon=True)
+        self.thread.start()
+
+    def record_event(self, door, event_time, state):
+        """Queue a door state change for writing"""
+        self.queue.put(('event', door, event_time, state == 'open'))
+
+    def record_alert(self, door, alert_time, msg, recipients):
+        """Queue a sent alert for writing"""
+        self.queue.put(('alert', door, alert_time, msg, recipients))
+
+    def run(self):
+        """Writer thread body. Writes whatever is queued in one transaction."""
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < 500:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            try:
+                self.db.execute('BEGIN')
+                for item in batch:
+                    if item is None:
+                        continue
+                    if item[0] == 'event':
+                        self.write_event(*item[1:])
+                    else:
+                        self.write_alert(*item[1:])
+                self.db.execute('COMMIT')
+            except sqlite3.Error as ex:
+                self.logger.error("Unable to write history %s: %s", self.filename, ex)
+                if self.db.in_transaction:
+                    self.db.execute('ROLLBACK')
+            if stop:
+                return
+
+    def door_id(self, name, create=True):
+        """Returns the ID of a door, adding it if needed and create is set"""
+        door_id = self.door_ids.get(name)
+        if door_id is None and create:
+            door_id = self.db.execute('INSERT INTO doors (name) VALUES (?)', (name,)).lastrowid
+            self.door_ids[name] = door_id
+        return door_id
+
+    def write_event(self, door, event_time, is_open):
+        """Record a state change, updating the daily rollups"""
+        door_id = self.door_id(door)
+        last = self.last_events.get(door_id)
+        if last is not None and (last[1] == is_open or last[0] >= event_time):
+            # Same state as before, e.g. after a restart
+            return
+
+        self.db.execute('INSERT OR REPLACE INTO events (door, time, open) VALUES (?, ?, ?)',
+                        (door_id, event_time, int(is_open)))
+        self.last_events[door_id] = (event_time, is_open)
+
+        if is_open:
+            self.add_to_day(door_id, local_midnight(event_time), 0, 1)
+        elif last is not None:
+            # Split the time it was open across the days it spanned
+            start = last[0]
+            while start < event_time:
+                day = local_midnight(start)
+                end = min(event_time, local_midnight(start, 1))
+                self.add_to_day(door_id, day, end - start, 0)
+                start = end
+
+    def add_to_day(self, door_id, day, open_seconds, cycles):
+        """Add to a door's rollup for one day"""
+        self.db.execute('INSERT INTO daily (door, day, open_seconds, cycles) VALUES (?, ?, ?, ?) '
+                        'ON CONFLICT (door, day) DO UPDATE SET open_seconds = open_seconds + excluded.open_seconds, '
+                        'cycles = cycles + excluded.cycles',
+                        (door_id, day, open_seconds, cycles))
+
+    def write_alert(self, door, alert_time, msg, recipients):
+        """Record an alert"""
+        self.db.execute('INSERT OR REPLACE INTO alerts (door, time, msg, recipients) VALUES (?, ?, ?, ?)',
+                        (self.door_id(door), alert_time, msg, recipients))
+
+    def query(self, sql, args):
+        """Run a query on the reader connection"""
+        with self.read_lock:
+            return self.reader.execute(sql, args).fetchall()
+
+    def open_time(self, door, start, end):
+        """Returns (seconds open, times opened) for a door between the
+        time.time()s start and end"""
+        door_id = self.door_ids.get(door)
+        if door_id is None:
+            return 0.0, 0
+
+        # Whole days come from the rollups and the partial days at either
+        # end from the events
+        first_day = local_midnight(start, 1) if start > local_midnight(start) else start
+        last_day = local_midnight(end)
+        if first_day >= last_day:
+            return self.open_time_from_events(door_id, start, end)
+
+        open_seconds, cycles = self.query('SELECT TOTAL(open_seconds), TOTAL(cycles) FROM daily '
+                                          'WHERE door = ? AND day >= ? AND day < ?',
+                                          (door_id, first_day, last_day))[0]
+        # The rollups only include open periods that have ended
+        last = self.query('SELECT time, open FROM events WHERE door = ? ORDER BY time DESC LIMIT 1', (door_id,))
+        if last and last[0][1]:
+            open_seconds += max(0, min(last_day, end) - max(first_day, last[0][0]))
+
+        for part_start, part_end in ((start, first_day), (last_day, end)):
+            if part_end > part_start:
+                part_open, part_cycles = self.open_time_from_events(door_id, part_start, part_end)
+                open_seconds += part_open
+                cycles += part_cycles
+        return open_seconds, int(cycles)
+
+    def open_time_from_events(self, door_id, start, end):
+        """open_time() for a short period, worked out from the events"""
+        before = self.query('SELECT open FROM events WHERE door = ? AND time <= ? ORDER BY time DESC LIMIT 1',
+                            (door_id, start))
+        is_open = bool(before and before[0][0])
+        since = start
+        open_seconds = 0.0
+        cycles = 0
+        for event_time, event_open in self.query('SELECT time, open FROM events WHERE door = ? AND time > ? AND time < ? '
+                                                 'ORDER BY time', (door_id, start, end)):
+            if is_open:
+                open_seconds += event_time - since
+            if event_open:
+                cycles += 1
+            is_open = bool(event_open)
+            since = event_time
+        if is_open:
+            open_seconds += end - since
+        return open_seconds, cycles
+
+    def events(self, start, end, limit=20):
+        """Returns the latest (door, time, state) state changes between start
+        and end, oldest first"""
+        rows = self.query('SELECT doors.name, events.time, events.open FROM events JOIN doors ON doors.id = events.door '
+                          'WHERE events.time >= ? AND events.time < ? ORDER BY events.time DESC LIMIT ?',
+                          (start, end, limit))
+        return [(name, event_time, 'open' if is_open else 'closed') for name, event_time, is_open in reversed(rows)]
+
+    def alerts(self, start, end, limit=20):
+        """Returns the total number of alerts between start and end, and
+        the latest (door, time, msg) of them, oldest first"""
+        count = self.query('SELECT COUNT(*) FROM alerts WHERE time >= ? AND time < ?', (start, end))[0][0]
+        rows = self.query('SELECT doors.name, alerts.time, alerts.msg FROM alerts JOIN doors ON doors.id = alerts.door '
+                          'WHERE alerts.time >= ? AND alerts.time < ? ORDER BY alerts.time DESC LIMIT ?',
+                          (start, end, limit))
+        return count, list(reversed(rows))
+
+    def close(self):
+        """Write out everything queued and close the database"""
+        self.queue.put(None)
+        self.thread.join()
+        if self.reader is not self.db:
+            self.reader.close()
+        self.db.close()
+
+##############################################################################
+# State checkpointing
+##############################################################################
+
+class StateCheckpoint:
+    """Saves door and alert state so it survives a restart
+
+    The state is written to a small JSON file, which is replaced atomically
+    so a crash or power cut mid-write leaves the previous version intact.
+    It is only written when something changes, not on every poll, and
+    then only once for all the changes in a pass of the main loop.
+    """
+
+    def __init__(self, filename):
+        self.logger = logging.getLogger(__name__)
+        self.filename = filename
+        self.dirty = False
+
+    def mark_dirty(self):
+        """Note that the state has changed and needs saving"""
+        self.dirty = True
+
+    def save_if_dirty(self, doors):
+        """Save the state if it has changed since it was last saved"""
+        if self.dirty:
+            self.save(doors)
+
+    def load(self):
+        """Returns the saved state as a dict of door name to a dict with the
+        door's 'state', the time.time() it changed 'since', and the index
+        of its next 'alert'"""
+        if not self.filename:
+            return {}
+        try:
+            with open(self.filename, 'r') as state_file:
+                return json.load(state_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as ex:
+            self.logger.warning("Unable to load saved state %s: %s", self.filename, ex)
+            return {}
+
+    def save(self, doors):
+        """Atomically replace the saved state
+
+        Args:
+            doors: List of DoorState
+        """
+        self.dirty = False
+        if not self.filename:
+            return
+        state = {door.name: {'state': door.state,
+                             'since': door.since,
+                             'alert': door.alert_index}
+                 for door in doors}
+        directory = os.path.dirname(self.filename) or '.'
+        tmp_filename = self.filename + '.tmp'
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(tmp_filename, 'w') as state_file:
+                json.dump(state, state_file, separators=(',', ':'))
+                state_file.flush()
+                os.fsync(state_file.fileno())
+            os.replace(tmp_filename, self.filename)
+
+            # Make sure the rename itself is on disk
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError as ex:
+            self.logger.warning("Unable to save state %s: %s", self.filename, ex)
+
+##############################################################################
+# Scheduling
+##############################################################################
+
+class SystemClock:
+    """The real wall and monotonic clocks"""
+
+    @staticmethod
+    def time():
+        """Returns the wall clock time, like time.time()"""
+        return time.time()
+
+    @staticmethod
+    def monotonic():
+        """Returns the monotonic clock, like time.monotonic()"""
+        return time.monotonic()
+
+class VirtualClock:
+    """A clock that only moves when told to, for simulations
+
+    The monotonic clock starts at zero and the wall clock at start.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.now = 0.0
+
+    def time(self):
+        """Returns the simulated wall clock time"""
+        return self.start + self.now
+
+    def monotonic(self):
+        """Returns the simulated monotonic clock"""
+        return self.now
+
+    def advance(self, now):
+        """Move the monotonic clock forward to now"""
+        self.now = max(self.now, now)
+
+class Scheduler:
+    """Runs callbacks at deadlines on the monotonic clock
+
+    Deadlines are kept in a heap, so finding the next one is O(1) and the
+    cost of each loop iteration depends only on how many events are due.
+    Each entry has a key; scheduling a key again replaces the previous
+    entry for it.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or SystemClock()
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+
+    def schedule(self, key, deadline, callback, *args):
+        """Run callback(*args) once the monotonic clock reaches deadline
+
+        Args:
+            key: Hashable identifying the entry, used to replace or cancel it
+            deadline: Monotonic clock value at which to run the callback
+            callback: Function to call
+            args: Arguments to the callback
+        """
+        self.cancel(key)
+        entry = [deadline, next(self.counter), key, callback, args]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+
+    def schedule_periodic(self, key, interval, callback, first=None):
+        """Run callback() every interval seconds
+
+        Args:
+            key: Hashable identifying the task
+            interval: Seconds between runs
+            callback: Function to call
+            first: Seconds until the first run, defaults to interval
+        """
+        def run_periodic(deadline):
+            # Reschedule relative to the deadline, not the time the
+            # callback finished, so the interval doesn't drift
+            self.schedule(key, deadline + interval, run_periodic, deadline + interval)
+            callback()
+
+        deadline = self.clock.monotonic() + (interval if first is None else first)
+        self.schedule(key, deadline, run_periodic, deadline)
+
+    def cancel(self, key):
+        """Cancel the entry for key, if any"""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            # Removing from the middle of a heap is expensive, so just
+            # disarm the entry and let run_due() discard it
+            entry[3] = None
+
+    def next_deadline(self):
+        """Returns the earliest pending deadline, or None if nothing is scheduled"""
+        while self.heap and self.heap[0][3] is None:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def run_due(self, now):
+        """Run every callback whose deadline is at or before now"""
+        while self.heap and self.heap[0][0] <= now:
+            _, _, key, callback, args = heapq.heappop(self.heap)
+            if callback is None:
+                continue
+            del self.entries[key]
+            callback(*args)
+
+##############################################################################
+# Door state
+##############################################################################
+
+class FlapDetector:
+    """Notices a door changing state too often, like a bouncing sensor or
+    a door being cycled over and over
+
+    Keeps the times of the door's state changes within the last window
+    seconds. The door is flapping once threshold changes fall within the
+    window, and stays flapping until it has been in one state for quiet
+    seconds, so a door hovering around the threshold doesn't keep going
+    in and out of flapping.
+    """
+
+    __slots__ = ('window', 'threshold', 'quiet', 'changes', 'flapping', 'flap_changes', 'routes',
+                 'last_alert_routes', 'last_alert_time')
+
+    def __init__(self, window=300, threshold=8, quiet=300):
+        self.window = window
+        self.threshold = threshold
+        self.quiet = quiet
+
+        # Monotonic clock times of the recent state changes
+        self.changes = collections.deque()
+        self.flapping = False
+
+        # State changes since the door started flapping
+        self.flap_changes = 0
+
+        # Recipients who were sent the flapping summary
+        self.routes = None
+
+        # Recipients of the door's last alert, and when it was sent
+        self.last_alert_routes = None
+        self.last_alert_time = None
+
+    def alerted(self, routes, now):
+        """Note that the door's alert went to routes at monotonic clock
+        time now"""
+        self.last_alert_routes = routes
+        self.last_alert_time = now
+
+    def recent_routes(self, now):
+        """Returns the recipients of the door's last alert if it was sent
+        within the window, otherwise None"""
+        if self.last_alert_time is None or self.last_alert_time <= now - self.window:
+            return None
+        return self.last_alert_routes
+
+    def record(self, now):
+        """Record a state change at monotonic clock time now
+
+        Returns:
+            True if this change started the door flapping
+        """
+        if self.threshold <= 0:
+            return False
+        self.changes.append(now)
+        while self.changes[0] <= now - self.window:
+            self.changes.popleft()
+        if self.flapping:
+            self.flap_changes += 1
+            return False
+        if len(self.changes) < self.threshold:
+            return False
+        self.flapping = True
+        self.flap_changes = 1
+        return True
+
+    def reset(self):
+        """Forget the flapping once the door has settled"""
+        self.changes.clear()
+        self.flapping = False
+        self.flap_changes = 0
+        self.routes = None
+
+class DoorState:
+    """Live state of one monitored door. Only the main loop touches these;
+    other threads read the DoorSnapshots it publishes."""
+
+    __slots__ = ('index', 'name', 'door', 'routes', 'state', 'since', 'since_monotonic', 'alert_index', 'flap')
+
+    def __init__(self, index, door, routes, state, clock):
+        # Position of the door in cfg.GARAGE_DOORS and in snapshots
+        self.index = index
+        self.name = door['name']
+
+        # Entry from cfg.GARAGE_DOORS and the compiled recipients of each
+        # of its alerts
+        self.door = door
+        self.routes = routes
+
+        # Last state, and the wall and monotonic clock times it was entered
+        self.state = state
+        self.since = clock.time()
+        self.since_monotonic = clock.monotonic()
+
+        # Index of the next alert to send
+        self.alert_index = 0
+
+        self.flap = FlapDetector(getattr(cfg, 'FLAP_WINDOW', 300), getattr(cfg, 'FLAP_THRESHOLD', 8),
+                                 getattr(cfg, 'FLAP_QUIET', 300))
+
+    def snapshot(self):
+        """Returns an immutable DoorSnapshot of this door"""
+        return DoorSnapshot(self.name, self.state, self.since, self.alert_index, self.flap.flapping)
+
+##############################################################################
+# Status server
+##############################################################################
+
+# Immutable views of the daemon's state, published by the main loop for
+# other threads to read
+DoorSnapshot = collections.namedtuple('DoorSnapshot', 'name state since alert_index flapping')
+StatusSnapshot = collections.namedtuple('StatusSnapshot', 'doors health')
+
+def prometheus_label(value):
+    """Escape a string for use as a Prometheus label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class StatusServer:
+    """Small HTTP server for monitoring
+
+    Serves a JSON status document at /status and Prometheus metrics at
+    /metrics. Runs an asyncio event loop on its own thread and only reads
+    the snapshots published by the main loop and the dispatcher, so a
+    scrape never touches GPIO or waits on the sensing loop.
+    """
+
+    def __init__(self, app, address, port):
+        self.logger = logging.getLogger(__name__)
+        self.app = app
+        self.address = address
+        self.port = port
+
+    def start(self):
+        """Start serving on a background thread"""
+        threading.Thread(target=asyncio.run, args=(self.serve(),), name='status-http', daemon=True).start()
+
+    async def serve(self):
+        """Accept connections until the daemon exits"""
+        server = await asyncio.start_server(self.handle_request, self.address, self.port)
+        self.logger.info("Status server listening on %s:%d", self.address or '*', self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_request(self, reader, writer):
+        """Answer a single HTTP request"""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            # Skip the headers
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass
+
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?')[0] if len(parts) > 1 else ''
+            if path in ('/', '/status'):
+                status, content_type, body = '200 OK', 'application/json', json.dumps(self.status_document())
+            elif path == '/metrics':
+                status, content_type, body = '200 OK', 'text/plain; version=0.0.4', self.metrics()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', 'Not found\n'
+
+            body = body.encode('utf-8')
+            writer.write(('HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                          % (status, content_type, len(body))).encode('latin-1') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def status_document(self):
+        """Returns the status as a dict ready to be turned into JSON"""
+        snapshot = self.app.snapshot
+        now = time.time()
+        return {
+            'time': now,
+            'doors': [{'name': door.name,
+                       'state': door.state,
+                       'since': door.since,
+                       'time_in_state': now - door.since,
+                       'alert_index': door.alert_index,
+                       'flapping': door.flapping} for door in snapshot.doors],
+            'channels': {channel: stats._asdict() for channel, stats in self.app.channel_stats().items()},
+            'health': snapshot.health,
+            'health_history': [sample._asdict() for sample in self.app.health_history()]
+        }
+
+    def metrics(self):
+        """Returns the metrics in the Prometheus text format"""
+        snapshot = self.app.snapshot
+        channel_stats = self.app.channel_stats()
+        now = time.time()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP pi_garage_alert_%s %s' % (name, help_text))
+            lines.append('# TYPE pi_garage_alert_%s %s' % (name, metric_type))
+            for labels, value in samples:
+                lines.append('pi_garage_alert_%s%s %s' % (name, labels, repr(float(value))))
+
+        doors = [('{door="%s"}' % (prometheus_label(door.name)), door) for door in snapshot.doors]
+        metric('door_open', 'gauge', 'Whether the door is open (1) or closed (0)',
+               [(labels, 1 if door.state == 'open' else 0) for labels, door in doors])
+        metric('door_time_in_state_seconds', 'gauge', 'Seconds since the door last changed state',
+               [(labels, now - door.since) for labels, door in doors])
+        metric('door_alert_index', 'gauge', 'Number of alerts sent since the door last changed state',
+               [(labels, door.alert_index) for labels, door in doors])
+        metric('door_flapping', 'gauge', 'Whether the door is changing state too often to send every change (1) or not (0)',
+               [(labels, 1 if door.flapping else 0) for labels, door in doors])
+
+        channels = [('{channel="%s"}' % (prometheus_label(channel)), stats) for channel, stats in sorted(channel_stats.items())]
+        metric('channel_sent_total', 'counter', 'Alerts delivered',
+               [(labels, stats.sent) for labels, stats in channels])
+        metric('channel_failed_total', 'counter', 'Failed send attempts',
+               [(labels, stats.failed) for labels, stats in channels])
+        metric('channel_skipped_total', 'counter', 'Sends skipped while the circuit breaker was open',
+               [(labels, stats.skipped) for labels, stats in channels])
+        metric('channel_rate_limited_total', 'counter', 'Sends refused by the service with a 429',
+               [(labels, stats.rate_limited) for labels, stats in channels])
+        metric('channel_queued', 'gauge', 'Sends waiting for the rate limit',
+               [(labels, stats.queued) for labels, stats in channels])
+        metric('channel_dropped_total', 'counter', 'Sends dropped because too many were waiting for the rate limit',
+               [(labels, stats.dropped) for labels, stats in channels])
+        metric('channel_send_seconds', 'summary', 'Time taken by send attempts',
+               [])
+        for labels, stats in channels:
+            lines.append('pi_garage_alert_channel_send_seconds_sum%s %r' % (labels, stats.latency_sum))
+            lines.append('pi_garage_alert_channel_send_seconds_count%s %r' % (labels, float(stats.sent + stats.failed + stats.rate_limited)))
+        metric('channel_send_seconds_max', 'gauge', 'Longest send attempt',
+               [(labels, stats.latency_max) for labels, stats in channels])
+
+        health = snapshot.health
+        for key, name, help_text in (('cpu_temp', 'cpu_temp_celsius', 'CPU temperature'),
+                                     ('gpu_temp', 'gpu_temp_celsius', 'GPU temperature'),
+                                     ('uptime', 'uptime_seconds', 'System uptime')):
+            if health.get(key) is not None:
+                metric(name, 'gauge', help_text, [('', health[key])])
+
+        return '\n'.join(lines) + '\n'
+
+##############################################################################
+# Log writing
+##############################################################################
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the LogWriter thread, dropping them if its queue is
+    full rather than making the caller wait"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats each record as one line of JSON"""
+
+    def format(self, record):
+        return json.dumps({'time': record.created,
+                           'level': record.levelname,
+                           'thread': record.threadName,
+                           'message': record.getMessage()})
+
+class LogWriter:
+    """Writes log records to the log file from a background thread
+
+    Records are written in batches, when batch_size records are waiting or
+    flush_interval seconds after the first of them arrived, so the SD card
+    sees a few large writes instead of one per message. Once the file
+    grows past max_bytes it is rotated, and old files are compressed with
+    gzip and kept up to backup_count of them.
+    """
+
+    def __init__(self, filename, formatter, queue_size=10000, batch_size=100, flush_interval=5,
+                 max_bytes=1048576, backup_count=5):
+        self.filename = filename
+        self.formatter = formatter
+        self.queue = queue.Queue(queue_size)
+        self.handler = DroppingQueueHandler(self.queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.log_file = open(filename, 'a', encoding='utf-8')
+        self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Writer thread body. A None record means stop."""
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                record = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                record = False
+
+            if record is None:
+                break
+            if record is not False:
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(self.format(record))
+
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self.write(batch)
+                batch = []
+                deadline = None
+
+        # Drain anything logged before stop()
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is not None:
+                batch.append(self.format(record))
+        self.write(batch)
+        self.log_file.close()
+
+    def format(self, record):
+        """Returns the line to write for a record"""
+        try:
+            return self.formatter.format(record) + '\n'
+        except Exception:
+            return "Unable to format log record: %s\n" % (record.msg)
+
+    def write(self, lines):
+        """Write lines to the log file in one go, then rotate if needed"""
+        if not lines:
+            return
+        try:
+            self.log_file.write(''.join(lines))
+            self.log_file.flush()
+            if self.max_bytes and self.log_file.tell() >= self.max_bytes:
+                self.rotate()
+        except OSError as ex:
+            print("Unable to write log %s: %s" % (self.filename, ex), file=sys.stderr)
+
+    def rotate(self):
+        """Move the log to filename.1.gz, shifting older ones up"""
+        self.log_file.close()
+        try:
+            for index in range(self.backup_count - 1, 0, -1):
+                older = '%s.%d.gz' % (self.filename, index)
+                if os.path.exists(older):
+                    os.replace(older, '%s.%d.gz' % (self.filename, index + 1))
+            if self.backup_count > 0:
+                with open(self.filename, 'rb') as log_file, gzip.open(self.filename + '.1.gz', 'wb') as compressed:
+                    shutil.copyfileobj(log_file, compressed)
+            os.remove(self.filename)
+        finally:
+            self.log_file = open(self.filename, 'a', encoding='utf-8')
+
+    def stop(self):
+        """Write out everything logged so far and stop the thread"""
+        logging.getLogger().removeHandler(self.handler)
+        self.queue.put(None)
+        self.thread.join()
+
+def setup_logging():
+    """Set up logging to stdout when run from a terminal, otherwise to
+    cfg.LOG_FILENAME through a LogWriter
+
+    Returns:
+        The LogWriter, or None when logging to stdout
+    """
+    log_fmt = '%(asctime)-15s %(levelname)-8s %(message)s'
+    log_level = logging.INFO
+
+    if sys.stdout.isatty():
+        # Connected to a real terminal - log to stdout
+        logging.basicConfig(format=log_fmt, level=log_level)
+        return None
+
+    # Background mode - log to file, without the sensing loop ever waiting
+    # on the SD card
+    if getattr(cfg, 'LOG_FORMAT', 'text') == 'json':
+        formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter(log_fmt)
+    writer = LogWriter(cfg.LOG_FILENAME, formatter,
+                       queue_size=getattr(cfg, 'LOG_QUEUE_SIZE', 10000),
+                       batch_size=getattr(cfg, 'LOG_BATCH_SIZE', 100),
+                       flush_interval=getattr(cfg, 'LOG_FLUSH_INTERVAL', 5),
+                       max_bytes=getattr(cfg, 'LOG_MAX_BYTES', 1048576),
+                       backup_count=getattr(cfg, 'LOG_BACKUP_COUNT', 5))
+    root = logging.getLogger()
+    root.addHandler(writer.handler)
+    root.setLevel(log_level)
+    return writer
+
+##############################################################################
+# Simulation
+##############################################################################
+
+# A door changing state, time seconds after the start of a simulation
+SimulationEvent = collections.namedtuple('SimulationEvent', 'time door state')
+
+# An alert that would have been sent, at wall clock time
+RecordedAlert = collections.namedtuple('RecordedAlert', 'time channel method args')
+
+class AlertRecorder:
+    """Stands in for AlertDispatcher during a simulation, printing and
+    recording each send instead of making it"""
+
+    def __init__(self, clock, output=sys.stdout):
+        self.clock = clock
+        self.output = output
+        self.alerts = []
+
+    def submit(self, channel, method, *args):
+        """Record a send"""
+        alert = RecordedAlert(self.clock.time(), channel, method, args)
+        self.alerts.append(alert)
+        print("%s %-10s %s%r" % (strftime('%Y-%m-%d %H:%M:%S', time.localtime(alert.time)),
+                                 channel, method, args), file=self.output)
+
+    @staticmethod
+    def open_circuits():
+        """There are no circuit breakers in a simulation"""
+        return []
+
+    def shutdown(self):
+        """Nothing to shut down"""
+
+def parse_duration(duration):
+    """Convert a duration like 90, 90s, 15m, 2h or 1.5d to seconds"""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if duration[-1:] in units:
+        return float(duration[:-1]) * units[duration[-1]]
+    return float(duration)
+
+def load_simulation_script(filename):
+    """Read door events from a simulation script
+
+    Each line is "<time> <door name> <open|closed>", where time is a
+    duration since the start of the simulation, e.g. 0, 30s, 15m or 2d.
+    Blank lines and lines starting with # are ignored.
+
+    Returns:
+        List of SimulationEvent in time order
+
+    Raises:
+        ConfigError: The script has an invalid line
+    """
+    events = []
+    with open(filename, 'r') as script:
+        for line_number, line in enumerate(script, 1):
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            try:
+                event_time, rest = line.split(None, 1)
+                door, state = rest.rsplit(None, 1)
+                if state not in ('open', 'closed'):
+                    raise ValueError(state)
+                events.append(SimulationEvent(parse_duration(event_time), door, state))
+            except ValueError:
+                raise ConfigError("Invalid line %d in %s: %s" % (line_number, filename, line))
+    return sorted(events, key=lambda event: event.time)
+
+# The door state messages logged by PiGarageAlert.update_door() and
+# restore_door(), and the lines they become in a text format log
+LOG_MESSAGE_RE = re.compile(r'^(?:State of|Initial state of) "(.*)" (?:changed to|is) (open|closed)\b')
+LOG_EVENT_RE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) \S+\s+' + LOG_MESSAGE_RE.pattern[1:])
+
+def load_log_events(filename):
+    """Recover the door events recorded in a Pi Garage Alert log, which may
+    be in either LOG_FORMAT and may be a compressed old log
+
+    Returns:
+        Tuple of the wall clock time of the first event, and a list of
+        SimulationEvent relative to it
+    """
+    events = []
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt', errors='replace') as log_file:
+        for line in log_file:
+            if line.startswith('{'):
+                # LOG_FORMAT = 'json'
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                match = LOG_MESSAGE_RE.match(record.get('message', ''))
+                if match is not None:
+                    events.append(SimulationEvent(record['time'], match.group(1), match.group(2)))
+                continue
+
+            match = LOG_EVENT_RE.match(line)
+            if match is None:
+                continue
+            stamp, millis, door, state = match.groups()
+            event_time = time.mktime(time.strptime(stamp, '%Y-%m-%d %H:%M:%S')) + int(millis) / 1000.0
+            events.append(SimulationEvent(event_time, door, state))
+
+    if not events:
+        return time.time(), []
+    start = events[0].time
+    return start, [event._replace(time=event.time - start) for event in events]
+
+def run_simulation(script=None, log=None):
+    """Simulate the configured alerts against a script or log and print a
+    summary"""
+    logging.basicConfig(format='%(levelname)-8s %(message)s', level=logging.WARNING)
+    try:
+        if log is not None:
+            start, events = load_log_events(log)
+        else:
+            start, events = time.time(), load_simulation_script(script)
+        started = time.perf_counter()
+        clock = VirtualClock(start)
+
+        # Plugin recipient types are needed to compile the doors, as in main()
+        SENDERS.load_plugins(getattr(cfg, 'SENDER_PLUGINS', []))
+        alerts = PiGarageAlert(clock).simulate(events)
+    except (ConfigError, OSError, ImportError) as ex:
+        logging.critical("Simulation failed: %s", ex)
+        return 1
+
+    print("%d events, %d alerts over %s of simulated time in %.0f ms" %
+          (len(events), len(alerts), format_duration(clock.monotonic()),
+           (time.perf_counter() - started) * 1000))
+    return 0
+
 ##############################################################################
 # Main functionality
 ##############################################################################
 class PiGarageAlert:
     """Class with main function of Pi Garage Alert"""
 
-    def __init__(self):
+    def __init__(self, clock=None):
         self.logger = logging.getLogger(__name__)
 
+        # Source of the current time. Only simulations replace it.
+        self.clock = clock or SystemClock()
+
+        # DoorState of each garage door, in config order
+        self.doors = []
+        self.doors_by_pin = collections.defaultdict(list)
+
+        self.checkpoint = StateCheckpoint(None)
+        self.scheduler = Scheduler(self.clock)
+        self.sensors = None
+        self.dispatcher = None
+        self.transport = None
+        self.alert_senders = dict()
+
+        # Latest StatusSnapshot. The main loop replaces it whenever
+        # anything changes, and never modifies a published one, so other
+        # threads can read it without locking.
+        self.health = dict()
+        self.snapshot = StatusSnapshot((), self.health)
+
+        self.log_writer = None
+
+        # AlertCoalescer, when cfg.ALERT_COALESCE_WINDOW is set
+        self.coalescer = None
+
+        self.health_sampler = None
+        self.health_alerts = []
+
+        # HistoryStore, when cfg.HISTORY_FILENAME is set
+        self.history = None
+
+        # EdgeMonitor, when sensing in edge mode
+        self.edge_monitor = None
+
+        # ConfigWatcher, when cfg.CONFIG_RELOAD is set. SIGHUP also asks
+        # for a reload.
+        self.config_watcher = None
+        self.reload_requested = False
+
+    def get_transport(self):
+        """Returns the HTTP transport shared by the HTTP based senders,
+        creating it on first use"""
+        if self.transport is None:
+            self.transport = HttpTransport(connect_timeout=getattr(cfg, 'HTTP_CONNECT_TIMEOUT', 5),
+                                           read_timeout=getattr(cfg, 'HTTP_READ_TIMEOUT', 15),
+                                           pool_size=getattr(cfg, 'HTTP_POOL_SIZE', 4))
+            prewarm_urls = getattr(cfg, 'HTTP_PREWARM_URLS', [])
+            if prewarm_urls:
+                threading.Thread(target=self.transport.prewarm, args=(prewarm_urls,), daemon=True).start()
+        return self.transport
+
+    def create_senders(self, channels):
+        """Import the modules for and create the senders of the given
+        channels, logging how long each one took
+
+        Returns:
+            Dict of channel name to sender
+        """
+        senders = dict()
+        startup = time.perf_counter()
+        for channel in sorted(channels):
+            spec = SENDERS.channels[channel]
+            start = time.perf_counter()
+            for module in spec.modules:
+                importlib.import_module(module)
+            imported = time.perf_counter()
+            senders[channel] = spec.factory(self)
+            self.logger.info("Loaded %s sender: import %.0f ms, setup %.0f ms", channel,
+                             (imported - start) * 1000, (time.perf_counter() - imported) * 1000)
+
+        self.logger.info("Loaded %d senders in %.0f ms, max RSS %.1f MB", len(senders),
+                         (time.perf_counter() - startup) * 1000,
+                         resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+        return senders
+
+    def read_doors(self, doors):
+        """Read the sensors of the given doors in one batch and process any
+        state changes
+
+        Args:
+            doors: List of DoorState
+        """
+        levels = self.sensors.read({door.door['pin'] for door in doors})
+        for door in doors:
+            self.update_door(door, 'open' if levels[door.door['pin']] else 'closed')
+
+    def update_door(self, door, state):
+        """Process a sensor reading for a door
+
+        Args:
+            door: DoorState of the door
+            state: State read from the sensor
+        """
+        if door.state == state:
+            return
+
+        time_in_state = self.clock.time() - door.since
+        door.state = state
+        door.since = self.clock.time()
+        door.since_monotonic = self.clock.monotonic()
+        self.logger.info("State of \"%s\" changed to %s after %.0f sec", door.name, state, time_in_state)
+        if self.history is not None:
+            self.history.record_event(door.name, door.since, state)
+
+        flap = door.flap
+        started_flapping = flap.record(door.since_monotonic)
+
+        # Reset alert when door changes state, letting the recipients of
+        # the last alert know unless the door is flapping
+        if door.alert_index > 0:
+            routes = door.routes[door.alert_index - 1]
+            if not flap.flapping:
+                self.send_alerts(routes, door.name, "%s is now %s" % (door.name, state), state, 0, 'door')
+                flap.alerted(routes, door.since_monotonic)
+            door.alert_index = 0
+
+        # Anyone alerted about the door within the flap window gets one
+        # summary instead of every change
+        if started_flapping:
+            self.logger.warning("\"%s\" is flapping (%d changes in %s), holding back its alerts",
+                                door.name, len(flap.changes), short_duration(flap.window))
+            flap.routes = flap.recent_routes(door.since_monotonic)
+            if flap.routes is not None:
+                self.send_alerts(flap.routes, door.name,
+                                 "%s is now %s, but is flapping (%d changes in %s). Further changes won't be sent until it settles."
+                                 % (door.name, state, len(flap.changes), short_duration(flap.window)), state, 0)
+
+        # Every change while flapping pushes back the time it can settle
+        if flap.flapping:
+            self.scheduler.schedule(('flap', door.name), door.since_monotonic + flap.quiet, self.door_settled, door)
+
+        self.door_changed(door)
+        self.schedule_alert(door)
+
+    def door_settled(self, door):
+        """Stop treating a door as flapping once it has been in one state
+        for the quiet period, letting anyone sent the flapping summary know"""
+        flap = door.flap
+        self.logger.info("\"%s\" has stopped flapping after %d changes", door.name, flap.flap_changes)
+        if flap.routes is not None:
+            time_in_state = self.clock.monotonic() - door.since_monotonic
+            self.send_alerts(flap.routes, door.name, "%s has stopped flapping after %d changes and is %s"
+                             % (door.name, flap.flap_changes, door.state), door.state, time_in_state)
+        flap.reset()
+        self.door_changed(door)
+        self.schedule_alert(door)
+
+    def door_changed(self, door):
+        """Mark the checkpoint for saving and publish a new snapshot after
+        a change to one of them. The main loop saves the checkpoint once
+        per pass, however many doors changed."""
+        self.checkpoint.mark_dirty()
+
+        # Copy on write - only the changed door gets a new DoorSnapshot
+        doors = list(self.snapshot.doors)
+        doors[door.index] = door.snapshot()
+        self.snapshot = StatusSnapshot(tuple(doors), self.health)
+
+    def publish_snapshot(self):
+        """Replace self.snapshot with a fresh copy of every door"""
+        self.snapshot = StatusSnapshot(tuple(door.snapshot() for door in self.doors), self.health)
+
+    def send_alerts(self, routes, subject, msg, state, time_in_state, kind='notice'):
+        """Send an alert through the coalescer, if enabled, or straight to
+        the dispatcher"""
+        if self.history is not None:
+            self.history.record_alert(subject, self.clock.time(), msg,
+                                      ', '.join('%s:%s' % (recipient_type.name, address) if address else recipient_type.name
+                                                for recipient_type, addresses in routes for address in addresses))
+        if self.coalescer is not None:
+            self.coalescer.add(routes, Alert(subject, msg, state, time_in_state, kind))
+        else:
+            send_alerts(self.dispatcher, routes, subject, msg, state, time_in_state, kind)
+
+    def create_coalescer(self):
+        """Set up alert coalescing if cfg.ALERT_COALESCE_WINDOW is set"""
+        window = getattr(cfg, 'ALERT_COALESCE_WINDOW', 0)
+        if window > 0:
+            self.coalescer = AlertCoalescer(self.dispatcher, self.scheduler, self.clock, window)
+
+    def channel_stats(self):
+        """Returns the dispatcher's latest per-channel ChannelStats"""
+        if self.dispatcher is None:
+            return {}
+        return self.dispatcher.channel_stats
+
+    def restore_door(self, door, saved):
+        """Carry over the time in state and alerts already sent from before
+        a restart
+
+        Args:
+            door: DoorState with the state just read from the sensor
+            saved: State saved by StateCheckpoint for this door, or None
+        """
+        if saved is None:
+            self.logger.info("Initial state of \"%s\" is %s", door.name, door.state)
+            return
+
+        # Ladder may have been shortened since the state was saved
+        alert_index = min(saved['alert'], len(door.routes))
+
+        if saved['state'] == door.state:
+            elapsed = max(self.clock.time() - saved['since'], 0)
+            door.since = saved['since']
+            door.since_monotonic = self.clock.monotonic() - elapsed
+            door.alert_index = alert_index
+            self.logger.info("Initial state of \"%s\" is %s, restored time in state of %.0f sec and %d alerts sent",
+                             door.name, door.state, elapsed, alert_index)
+        else:
+            self.logger.info("Initial state of \"%s\" is %s, was %s before restart", door.name, door.state, saved['state'])
+            if alert_index > 0:
+                # Let the recipients of the last alert know, as if the
+                # change had been seen while running
+                routes = door.routes[alert_index - 1]
+                self.send_alerts(routes, door.name, "%s is now %s" % (door.name, door.state), door.state, 0, 'door')
+
+    def schedule_alert(self, door):
+        """Schedule the next alert for a door, if the door is in the state it
+        needs to be in for that alert. Alerts wait while the door is
+        flapping; one that fell due meanwhile goes out when it settles."""
+        key = ('alert', door.name)
+
+        if len(door.door['alerts']) > door.alert_index and not door.flap.flapping:
+            alert = door.door['alerts'][door.alert_index]
+            if door.state == alert['state']:
+                deadline = door.since_monotonic + alert['time']
+                self.scheduler.schedule(key, deadline, self.send_door_alert, door)
+                return
+
+        self.scheduler.cancel(key)
+
+    def send_door_alert(self, door):
+        """Send the next alert for a door once its deadline has passed"""
+        name = door.name
+        state = door.state
+        time_in_state = self.clock.monotonic() - door.since_monotonic
+
+        routes = door.routes[door.alert_index]
+        self.send_alerts(routes, name, "%s has been %s for %d seconds!" % (name, state, time_in_state), state, time_in_state,
+                         'door')
+        door.flap.alerted(routes, self.clock.monotonic())
+        door.alert_index += 1
+        self.door_changed(door)
+        self.schedule_alert(door)
+
+    def check_health(self):
+        """Publish the latest health readings and send any health alerts
+        whose thresholds have been crossed"""
+        health = self.health_sampler.latest
+        if health is self.health:
+            return
+        self.health = health
+        self.publish_snapshot()
+
+        for alert in self.health_alerts:
+            value = health.get(alert.reading)
+            if value is None:
+                continue
+            name = HEALTH_READINGS[alert.reading]
+            if not alert.active and value > alert.above:
+                alert.active = True
+                msg = "%s is %.1f C, over %.1f C" % (name, value, alert.above)
+                self.logger.warning(msg)
+                self.send_alerts(alert.routes, "Pi Garage Alert", msg, 'hot', 0)
+            elif alert.active and value < alert.clear_below:
+                alert.active = False
+                msg = "%s is back to %.1f C" % (name, value)
+                self.logger.info(msg)
+                self.send_alerts(alert.routes, "Pi Garage Alert", msg, 'normal', 0)
+
+    def health_history(self):
+        """Returns the recent HealthSamples, oldest first"""
+        if self.health_sampler is None:
+            return []
+        return self.health_sampler.recent()
+
+    def status_report(self):
+        """Log the status for debug and ensuring RPi doesn't get too hot"""
+        status_msg = rpi_status(self.health)
+
+        for door in self.doors:
+            status_msg += ", %s: %s/%d/%d" % (door.name, door.state, door.alert_index, (self.clock.time() - door.since))
+
+        jabber = self.alert_senders.get('Jabber')
+        if jabber is not None and jabber.client is not None:
+            status_msg += ", Jabber %s" % ('connected' if jabber.connected else 'disconnected')
+
+        for channel, skipped in self.dispatcher.open_circuits():
+            status_msg += ", %s circuit open (%d skipped)" % (channel, skipped)
+
+        for channel, stats in sorted(self.channel_stats().items()):
+            if stats.queued or stats.dropped:
+                status_msg += ", %s rate limited (%d queued, %d dropped)" % (channel, stats.queued, stats.dropped)
+
+        if self.transport is not None:
+            status_msg += ", HTTP pool hits/misses: %(hits)d/%(misses)d" % self.transport.pool_stats()
+
+        if self.log_writer is not None and self.log_writer.handler.dropped:
+            status_msg += ", %d log messages dropped" % (self.log_writer.handler.dropped)
+
+        self.logger.info(status_msg)
+
+    def terminate(self, signum, frame):
+        """SIGTERM handler. Unwinds main() so everything is shut down
+        cleanly, including flushing the log."""
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        raise SystemExit(signum)
+
+    def request_reload(self, signum=None, frame=None):
+        """SIGHUP handler, also called by the config watcher when the file
+        changes. The reload itself happens on the main loop, which is woken
+        if it is waiting for sensor edges."""
+        self.reload_requested = True
+        if self.edge_monitor is not None:
+            self.edge_monitor.wake()
+
+    def poll_config(self):
+        """Request a reload if the file changed, where inotify isn't available"""
+        if self.config_watcher.changed():
+            self.reload_requested = True
+
+    def check_config(self):
+        """Reload the config if a reload was requested"""
+        if self.reload_requested:
+            self.reload_requested = False
+            self.reload_config()
+
+    def reload_config(self):
+        """Load the config file again and apply whatever changed
+
+        The new config is checked in full before cfg is touched; if it is
+        invalid in any way the running config is kept. Doors, alert
+        ladders and senders that didn't change carry on untouched, along
+        with their timers and connections.
+        """
+        filename = getattr(cfg, '__file__', None)
+        if filename is None:
+            return
+        self.logger.info("Reloading config from %s", filename)
+        try:
+            new_cfg = load_config(filename)
+            door_routes = compile_doors(getattr(new_cfg, 'GARAGE_DOORS', None))
+            health_alerts = compile_health_alerts(getattr(new_cfg, 'HEALTH_ALERTS', []))
+            check_reloadable_settings(new_cfg)
+        except ConfigError as ex:
+            self.logger.error("Keeping the running config: %s", ex)
+            return
+        except Exception:
+            # A mistake the checks didn't anticipate mustn't stop the daemon
+            self.logger.error("Keeping the running config, it is invalid: %s", traceback.format_exc())
+            return
+
+        old_settings = config_settings(cfg)
+        new_settings = config_settings(new_cfg)
+        missing = object()
+        changed = {name for name in set(old_settings) | set(new_settings)
+                   if old_settings.get(name, missing) != new_settings.get(name, missing)}
+        deferred = {name for name in changed if name.startswith(RESTART_SETTINGS)}
+        if deferred:
+            self.logger.warning("Restart to apply the changes to %s", ', '.join(sorted(deferred)))
+        changed -= deferred
+        if not changed:
+            self.logger.info("No settings changed that can be applied while running")
+            return
+        self.logger.info("Applying changes to %s", ', '.join(sorted(changed)))
+
+        for name in changed:
+            if name in new_settings:
+                setattr(cfg, name, new_settings[name])
+            else:
+                delattr(cfg, name)
+
+        if 'GARAGE_DOORS' in changed:
+            self.reload_doors(door_routes)
+        else:
+            door_routes = {door.name: door.routes for door in self.doors}
+        for door in self.doors:
+            door.flap.window = getattr(cfg, 'FLAP_WINDOW', 300)
+            door.flap.threshold = getattr(cfg, 'FLAP_THRESHOLD', 8)
+            door.flap.quiet = getattr(cfg, 'FLAP_QUIET', 300)
+
+        # Health alerts that are firing stay firing
+        active = {(alert.reading, alert.above) for alert in self.health_alerts if alert.active}
+        for alert in health_alerts:
+            alert.active = (alert.reading, alert.above) in active
+        self.health_alerts = health_alerts
+
+        # Senders read their settings, including their timeout, when they
+        # are created
+        old_timeouts = old_settings.get('CHANNEL_TIMEOUTS', {})
+        new_timeouts = new_settings.get('CHANNEL_TIMEOUTS', {})
+        stale = {channel for channel in self.alert_senders
+                 if any(name.startswith(SENDERS.channels[channel].settings) for name in changed)
+                 or old_timeouts.get(channel) != new_timeouts.get(channel)}
+        self.reload_senders(stale, configured_channels(door_routes, health_alerts))
+
+        window = getattr(cfg, 'ALERT_COALESCE_WINDOW', 0)
+        if self.coalescer is not None and self.coalescer.window != window:
+            self.coalescer.flush()
+            self.coalescer = None
+        if self.coalescer is None:
+            self.create_coalescer()
+
+    def reload_doors(self, door_routes):
+        """Bring self.doors in line with a reloaded cfg.GARAGE_DOORS
+
+        Doors are matched by name. Ones still configured keep their state
+        and time in state, and only pick up their new pin and alerts. New
+        doors are set up and read straight away.
+
+        Args:
+            door_routes: compile_doors() of the new cfg.GARAGE_DOORS
+        """
+        old_doors = {door.name: door for door in self.doors}
+        for name in old_doors:
+            if name not in door_routes:
+                self.logger.info("No longer monitoring \"%s\"", name)
+                self.scheduler.cancel(('alert', name))
+                self.scheduler.cancel(('flap', name))
+
+        # Set up any pins which weren't in use before
+        old_pins = {door.door['pin'] for door in self.doors}
+        new_pins = []
+        for door_cfg in cfg.GARAGE_DOORS:
+            if door_cfg['pin'] not in old_pins and door_cfg['pin'] not in new_pins:
+                self.logger.info("Configuring pin %d for \"%s\"", door_cfg['pin'], door_cfg['name'])
+                new_pins.append(door_cfg['pin'])
+        if new_pins:
+            self.sensors.setup(new_pins)
+            if self.edge_monitor is not None:
+                self.edge_monitor.watch(new_pins)
+
+        # New doors, including renamed ones, may be on pins already in use
+        levels = self.sensors.read({door_cfg['pin'] for door_cfg in cfg.GARAGE_DOORS
+                                    if door_cfg['name'] not in old_doors})
+
+        doors = []
+        moved = []
+        for index, door_cfg in enumerate(cfg.GARAGE_DOORS):
+            door = old_doors.get(door_cfg['name'])
+            if door is None:
+                state = 'open' if levels[door_cfg['pin']] else 'closed'
+                door = DoorState(index, door_cfg, door_routes[door_cfg['name']], state, self.clock)
+                self.logger.info("Initial state of \"%s\" is %s", door.name, door.state)
+                if self.history is not None:
+                    self.history.record_event(door.name, door.since, door.state)
+            else:
+                if door.door['pin'] != door_cfg['pin']:
+                    moved.append(door)
+                door.index = index
+                door.door = door_cfg
+                door.routes = door_routes[door.name]
+                door.alert_index = min(door.alert_index, len(door.routes))
+            doors.append(door)
+
+        self.doors = doors
+        self.doors_by_pin = collections.defaultdict(list)
+        for door in doors:
+            self.doors_by_pin[door.door['pin']].append(door)
+            self.schedule_alert(door)
+        self.checkpoint.save(self.doors)
+        self.publish_snapshot()
+
+        # A door moved to another pin may have a different state there
+        if moved:
+            self.read_doors(moved)
+
+    def reload_senders(self, stale, channels):
+        """Create, replace and stop senders after a config reload
+
+        Senders still needed whose settings didn't change are kept, along
+        with their connections.
+
+        Args:
+            stale: Channels whose senders' settings changed
+            channels: Channels the reloaded config uses
+        """
+        senders = dict()
+        stopped = dict()
+        for channel, sender in self.alert_senders.items():
+            if channel in channels and channel not in stale:
+                senders[channel] = sender
+            else:
+                stopped[channel] = sender
+
+        for channel in sorted(channels - set(senders)):
+            try:
+                senders.update(self.create_senders([channel]))
+            except Exception:
+                self.logger.error("Can't create %s sender, its alerts will be dropped: %s",
+                                  channel, traceback.format_exc())
+
+        self.alert_senders = senders
+        self.dispatcher.update_senders(senders, channel_limits=getattr(cfg, 'ALERT_CHANNEL_CONCURRENCY', {}),
+                                       rate_limits=getattr(cfg, 'RATE_LIMITS', {}),
+                                       recipient_rate_limits=getattr(cfg, 'RECIPIENT_RATE_LIMITS', {}))
+
+        for channel, sender in sorted(stopped.items()):
+            self.logger.info("Stopping old %s sender", channel)
+            if hasattr(sender, 'terminate'):
+                sender.terminate()
+
+    def simulate(self, events):
+        """Run the alert logic against a sequence of door events on a
+        virtual clock, printing every alert instead of sending it
+
+        The doors, alert ladders and recipients come from the config as
+        usual, but no sensors or senders are touched and no state is
+        saved, so this can be run alongside the daemon.
+
+        Args:
+            events: List of SimulationEvent, in time order
+
+        Returns:
+            List of the RecordedAlerts that would have been sent
+        """
+        door_routes = compile_doors(cfg.GARAGE_DOORS)
+        recorder = AlertRecorder(self.clock)
+        self.dispatcher = recorder
+        self.create_coalescer()
+
+        # Doors start closed; an event at time zero sets the real initial state
+        for index, door_cfg in enumerate(cfg.GARAGE_DOORS):
+            door = DoorState(index, door_cfg, door_routes[door_cfg['name']], 'closed', self.clock)
+            self.doors.append(door)
+            self.schedule_alert(door)
+        self.publish_snapshot()
+        doors_by_name = {door.name: door for door in self.doors}
+
+        def run_until(now):
+            # Jump straight from one deadline to the next. With now None,
+            # run until nothing is left scheduled.
+            deadline = self.scheduler.next_deadline()
+            while deadline is not None and (now is None or deadline <= now):
+                self.clock.advance(deadline)
+                self.scheduler.run_due(deadline)
+                deadline = self.scheduler.next_deadline()
+            if now is not None:
+                self.clock.advance(now)
+
+        for event in events:
+            run_until(event.time)
+            door = doors_by_name.get(event.door)
+            if door is None:
+                self.logger.warning("Ignoring event for unknown door \"%s\"", event.door)
+                continue
+            self.update_door(door, event.state)
+
+        # Let the alert ladders play out after the last event
+        run_until(None)
+        return recorder.alerts
+
     def main(self):
         """Main functionality
         """
 
         try:
             # Set up logging
-            log_fmt = '%(asctime)-15s %(levelname)-8s %(message)s'
-            log_level = logging.INFO
+            self.log_writer = setup_logging()
 
-            if sys.stdout.isatty():
-                # Connected to a real terminal - log to stdout
-                logging.basicConfig(format=log_fmt, level=log_level)
-            else:
-                # Background mode - log to file
-                logging.basicConfig(format=log_fmt, level=log_level, filename=cfg.LOG_FILENAME)
+            # service stop and restart send SIGTERM
+            if threading.current_thread() is threading.main_thread():
+                signal.signal(signal.SIGTERM, self.terminate)
 
             # Banner
             self.logger.info("==========================================================")
             self.logger.info("Pi Garage Alert starting")
 
-            # Use Raspberry Pi board pin numbers
-            self.logger.info("Configuring global settings")
-            GPIO.setmode(GPIO.BOARD)
+            # Check the config and work out where each alert goes before
+            # doing anything else
+            SENDERS.load_plugins(getattr(cfg, 'SENDER_PLUGINS', []))
+            door_routes = compile_doors(cfg.GARAGE_DOORS)
+            self.health_alerts = compile_health_alerts(getattr(cfg, 'HEALTH_ALERTS', []))
 
-            # Configure the sensor pins as inputs with pull up resistors
+            # Configure the sensor inputs
+            self.logger.info("Configuring global settings")
+            self.sensors = create_sensor_backend()
             for door in cfg.GARAGE_DOORS:
                 self.logger.info("Configuring pin %d for \"%s\"", door['pin'], door['name'])
-                GPIO.setup(door['pin'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
-
-            # Last state of each garage door
-            door_states = dict()
-
-            # time.time() of the last time the garage door changed state
-            time_of_last_state_change = dict()
-
-            # Index of the next alert to send for each garage door
-            alert_states = dict()
-
-            # Create alert sending objects
-            alert_senders = {
-                "Jabber": Jabber(door_states, time_of_last_state_change),
-                "Twitter": Twitter(),
-                "Twilio": Twilio(),
-                "Email": Email(),
-                "Pushbullet": Pushbullet(),
-                "IFTTT": IFTTT(),
-                "CiscoSpark": CiscoSpark(),
-                "Gcm": GoogleCloudMessaging(),
-                "Slack": Slack()
-            }
-
-            # Read initial states
-            for door in cfg.GARAGE_DOORS:
-                name = door['name']
-                state = get_garage_door_state(door['pin'])
-
-                door_states[name] = state
-                time_of_last_state_change[name] = time.time()
-                alert_states[name] = 0
-
-                self.logger.info("Initial state of \"%s\" is %s", name, state)
+            self.sensors.setup([door['pin'] for door in cfg.GARAGE_DOORS])
+
+            # Only load the senders for channels the config actually uses
+            self.alert_senders = self.create_senders(configured_channels(door_routes, self.health_alerts))
+
+            # Alerts are sent from a worker pool so slow services don't
+            # hold up the sensing loop. Every send is spooled to disk first
+            # and retried until it is delivered.
+            spool = AlertSpool(getattr(cfg, 'SPOOL_FILENAME', None))
+            self.dispatcher = AlertDispatcher(self.alert_senders, spool,
+                                              max_workers=getattr(cfg, 'ALERT_WORKERS', 4),
+                                              channel_limits=getattr(cfg, 'ALERT_CHANNEL_CONCURRENCY', {}),
+                                              retry_min=getattr(cfg, 'SPOOL_RETRY_MIN', 5),
+                                              retry_max=getattr(cfg, 'SPOOL_RETRY_MAX', 600),
+                                              max_age=getattr(cfg, 'SPOOL_MAX_AGE', 86400),
+                                              compact_interval=getattr(cfg, 'SPOOL_COMPACT_INTERVAL', 3600),
+                                              breaker_threshold=getattr(cfg, 'CIRCUIT_BREAKER_THRESHOLD', 5),
+                                              breaker_reset=getattr(cfg, 'CIRCUIT_BREAKER_RESET', 60),
+                                              rate_limits=getattr(cfg, 'RATE_LIMITS', {}),
+                                              recipient_rate_limits=getattr(cfg, 'RECIPIENT_RATE_LIMITS', {}),
+                                              max_queued=getattr(cfg, 'RATE_LIMIT_MAX_QUEUED', 1000),
+                                              recipient_of=SENDERS.recipient)
+            self.create_coalescer()
+
+            # Read initial states, picking up where the last run left off
+            self.checkpoint = StateCheckpoint(getattr(cfg, 'STATE_FILENAME', None))
+            if getattr(cfg, 'HISTORY_FILENAME', ''):
+                self.history = HistoryStore(cfg.HISTORY_FILENAME)
+            saved_states = self.checkpoint.load()
+            levels = self.sensors.read([door['pin'] for door in cfg.GARAGE_DOORS])
+            for index, door_cfg in enumerate(cfg.GARAGE_DOORS):
+                state = 'open' if levels[door_cfg['pin']] else 'closed'
+                door = DoorState(index, door_cfg, door_routes[door_cfg['name']], state, self.clock)
+                self.doors.append(door)
+                self.doors_by_pin[door_cfg['pin']].append(door)
+                self.restore_door(door, saved_states.get(door.name))
+                if self.history is not None:
+                    self.history.record_event(door.name, door.since, door.state)
+                self.schedule_alert(door)
+            self.checkpoint.save(self.doors)
+            self.publish_snapshot()
+
+            # Optional HTTP status and metrics endpoint
+            if getattr(cfg, 'STATUS_HTTP_PORT', 0):
+                StatusServer(self, getattr(cfg, 'STATUS_HTTP_ADDRESS', ''), cfg.STATUS_HTTP_PORT).start()
+
+            # In poll mode every pin is read once a second. In edge mode the
+            # loop sleeps until a pin changes or something is due, and only
+            # re-reads every pin occasionally in case an edge was missed.
+            if getattr(cfg, 'SENSOR_MODE', 'poll') == 'edge' and not self.sensors.supports_edges:
+                self.logger.warning("Sensor backend doesn't support edge detection, polling instead")
+            elif getattr(cfg, 'SENSOR_MODE', 'poll') == 'edge':
+                self.logger.info("Using edge-triggered sensing")
+                self.edge_monitor = EdgeMonitor(self.sensors, list(self.doors_by_pin),
+                                           getattr(cfg, 'SENSOR_DEBOUNCE_MS', 50))
+                poll_interval = getattr(cfg, 'SENSOR_SAFETY_INTERVAL', 60)
+            else:
+                poll_interval = 1
+            self.scheduler.schedule_periodic('poll', poll_interval, lambda: self.read_doors(self.doors))
+
+            # Health readings are taken on their own thread; the main loop
+            # only looks at the latest ones
+            health_interval = getattr(cfg, 'HEALTH_SAMPLE_INTERVAL', 10)
+            self.health_sampler = HealthSampler(interval=health_interval,
+                                                gpu_interval=getattr(cfg, 'HEALTH_GPU_INTERVAL', 60),
+                                                history=getattr(cfg, 'HEALTH_HISTORY', 360)).start()
+            self.check_health()
+            self.scheduler.schedule_periodic('health', health_interval, self.check_health)
+
+            self.scheduler.schedule_periodic('status', 600, self.status_report, first=5)
+
+            # Pick up config changes without a restart, when the file is
+            # saved or on SIGHUP. Only poll the file if inotify can't tell
+            # us it changed.
+            if getattr(cfg, 'CONFIG_RELOAD', True) and getattr(cfg, '__file__', None):
+                self.config_watcher = ConfigWatcher(cfg.__file__)
+                if not self.config_watcher.start(self.request_reload):
+                    self.scheduler.schedule_periodic('config', getattr(cfg, 'CONFIG_CHECK_INTERVAL', 2),
+                                                     self.poll_config)
+            if threading.current_thread() is threading.main_thread():
+                signal.signal(signal.SIGHUP, self.request_reload)
 
-            status_report_countdown = 5
             while True:
-                for door in cfg.GARAGE_DOORS:
-                    name = door['name']
-                    state = get_garage_door_state(door['pin'])
-                    time_in_state = time.time() - time_of_last_state_change[name]
-
-                    # Check if the door has changed state
-                    if door_states[name] != state:
-                        door_states[name] = state
-                        time_of_last_state_change[name] = time.time()
-                        self.logger.info("State of \"%s\" changed to %s after %.0f sec", name, state, time_in_state)
-
-                        # Reset alert when door changes state
-                        if alert_states[name] > 0:
-                            # Use the recipients of the last alert
-                            recipients = door['alerts'][alert_states[name] - 1]['recipients']
-                            send_alerts(self.logger, alert_senders, recipients, name, "%s is now %s" % (name, state), state, 0)
-                            alert_states[name] = 0
-
-                        # Reset time_in_state
-                        time_in_state = 0
-
-                    # See if there are more alerts
-                    if len(door['alerts']) > alert_states[name]:
-                        # Get info about alert
-                        alert = door['alerts'][alert_states[name]]
-
-                        # Has the time elapsed and is this the state to trigger the alert?
-                        if time_in_state > alert['time'] and state == alert['state']:
-                            send_alerts(self.logger, alert_senders, alert['recipients'], name, "%s has been %s for %d seconds!" % (name, state, time_in_state), state, time_in_state)
-                            alert_states[name] += 1
-
-                # Periodically log the status for debug and ensuring RPi doesn't get too hot
-                status_report_countdown -= 1
-                if status_report_countdown <= 0:
-                    status_msg = rpi_status()
-
-                    for name in door_states:
-                        status_msg += ", %s: %s/%d/%d" % (name, door_states[name], alert_states[name], (time.time() - time_of_last_state_change[name]))
-
-                    self.logger.info(status_msg)
-
-                    status_report_countdown = 600
-
-                # Poll every 1 second
-                time.sleep(1)
+                self.scheduler.run_due(self.clock.monotonic())
+                self.check_config()
+                self.checkpoint.save_if_dirty(self.doors)
+
+                # Sleep until the next deadline or a sensor event
+                timeout = self.scheduler.next_deadline() - self.clock.monotonic()
+                if self.edge_monitor is None:
+                    time.sleep(max(timeout, 0))
+                else:
+                    for pin in self.edge_monitor.wait(timeout):
+                        # The door on a pin may have been removed by a reload
+                        self.read_doors(self.doors_by_pin.get(pin, []))
+        except ConfigError as ex:
+            logging.critical("Terminating due to configuration error: %s", ex)
         except KeyboardInterrupt:
             logging.critical("Terminating due to keyboard interrupt")
+        except SystemExit:
+            logging.critical("Terminating due to SIGTERM")
         except:
             logging.critical("Terminating due to unexpected error: %s", sys.exc_info()[0])
             logging.critical("%s", traceback.format_exc())
 
-        GPIO.cleanup() # pylint: disable=no-member
-        alert_senders['Jabber'].terminate()
+        self.checkpoint.save_if_dirty(self.doors)
+        if self.config_watcher is not None:
+            self.config_watcher.close()
+        if self.sensors is not None:
+            self.sensors.cleanup()
+        if self.health_sampler is not None:
+            self.health_sampler.stop()
+        if self.coalescer is not None:
+            self.coalescer.flush()
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown()
+        if self.history is not None:
+            self.history.close()
+        for sender in self.alert_senders.values():
+            if hasattr(sender, 'terminate'):
+                sender.terminate()
+        if self.log_writer is not None:
+            self.log_writer.stop()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Alert if a garage door is left open")
+    parser.add_argument('--simulate', metavar='SCRIPT',
+                        help="print the alerts the config would send for the door events in SCRIPT, then exit")
+    parser.add_argument('--replay-log', metavar='LOG', nargs='?', const=cfg.LOG_FILENAME,
+                        help="like --simulate, but with the door events recorded in a log file "
+                             "(default %(const)s)")
+    args = parser.parse_args()
+    if args.simulate is not None or args.replay_log is not None:
+        sys.exit(run_simulation(args.simulate, args.replay_log))
     PiGarageAlert().main()
@@ -41,9 +41,202 @@ GARAGE_DOORS = [
     }
 ]
 
-# All messages will be logged to stdout and this file
+# What the sensors are wired to:
+#   'rpi'       - the Raspberry Pi GPIO header. Pins are board pin numbers.
+#   'mcp23017'  - MCP23017 I2C port expanders. Pins 0-15 are the first
+#                 expander in SENSOR_I2C_ADDRESSES, 16-31 the second, etc.
+#   'simulated' - no hardware. Doors start closed and follow the script in
+#                 SENSOR_SIMULATION_FILENAME, if set. Each line of the
+#                 script is "<seconds since start> <pin> <open|closed>".
+SENSOR_BACKEND = 'rpi'
+SENSOR_I2C_BUS = 1
+SENSOR_I2C_ADDRESSES = [0x20]
+SENSOR_SIMULATION_FILENAME = ''
+
+# How the sensors are read. 'poll' reads every pin once a second. 'edge'
+# sleeps until a pin changes level, which reacts faster and lets the CPU
+# idle between events.
+SENSOR_MODE = 'poll'
+
+# In edge mode, how long a pin must be stable before its level is read
+SENSOR_DEBOUNCE_MS = 50
+
+# In edge mode, all pins are also re-read this often (in seconds) in case
+# an edge was missed
+SENSOR_SAFETY_INTERVAL = 60
+
+# Modules providing extra alert channels. Each module needs a
+# register(registry) function, which adds its channel and recipient types
+# with registry.add_channel() and registry.add_recipient_type().
+SENDER_PLUGINS = []
+
+# Reload this file when it is saved, without restarting. Doors, alerts,
+# recipients, rate limits, sender credentials and timeouts take effect
+# straight away; other settings are only read at startup. Changes are
+# picked up with inotify, or where that isn't available by checking the
+# file every CONFIG_CHECK_INTERVAL seconds. The file can also be reloaded
+# with SIGHUP (/etc/init.d/pi_garage_alert reload). An invalid file is
+# logged and ignored.
+CONFIG_RELOAD = True
+CONFIG_CHECK_INTERVAL = 2
+
+# Door states and the alerts already sent are saved here whenever they
+# change, so a restart doesn't reset how long a door has been open or
+# resend alerts. Set to '' to disable.
+STATE_FILENAME = "/var/lib/pi_garage_alert/state.json"
+
+# Every door state change and alert is recorded in this database, for the
+# Jabber history, opentime and alerts commands. Set to '' to disable.
+HISTORY_FILENAME = "/var/lib/pi_garage_alert/history.db"
+
+# Serve a JSON status document at http://<address>:<port>/status and
+# Prometheus metrics at /metrics. Set the port to 0 to disable. An empty
+# address listens on all interfaces.
+STATUS_HTTP_ADDRESS = ''
+STATUS_HTTP_PORT = 0
+
+# The CPU temperature and uptime are sampled every HEALTH_SAMPLE_INTERVAL
+# seconds and the GPU temperature every HEALTH_GPU_INTERVAL seconds (0 to
+# not sample it). The last HEALTH_HISTORY samples are kept and served by
+# the status endpoint.
+HEALTH_SAMPLE_INTERVAL = 10
+HEALTH_GPU_INTERVAL = 60
+HEALTH_HISTORY = 360
+
+# Alerts when the Pi gets too hot. Each alert fires when its 'reading'
+# ('cpu_temp' or 'gpu_temp') goes above 'above' degrees C, and sends an
+# all clear once it's back below 'clear_below' (default 5 degrees lower).
+# Recipients are the same as for door alerts, e.g.
+# HEALTH_ALERTS = [
+#     {
+#         'reading': 'cpu_temp',
+#         'above': 75,
+#         'clear_below': 70,
+#         'recipients': [ 'email:someone@example.com' ]
+#     }
+# ]
+HEALTH_ALERTS = []
+
+# All messages will be logged to stdout when run from a terminal, and to
+# this file otherwise
 LOG_FILENAME = "/var/log/pi_garage_alert.log"
 
+# 'text' for the usual log lines, or 'json' for one JSON object per line
+LOG_FORMAT = 'text'
+
+# The log file is written from a background thread in batches, when
+# LOG_BATCH_SIZE messages are waiting or LOG_FLUSH_INTERVAL seconds after
+# the first one, to save wear on the SD card. If more than LOG_QUEUE_SIZE
+# messages are waiting, new ones are dropped rather than holding up door
+# sensing.
+LOG_FLUSH_INTERVAL = 5
+LOG_BATCH_SIZE = 100
+LOG_QUEUE_SIZE = 10000
+
+# Once the log file reaches LOG_MAX_BYTES it is compressed to
+# LOG_FILENAME.1.gz, keeping up to LOG_BACKUP_COUNT old logs. Set
+# LOG_MAX_BYTES to 0 to leave rotation to logrotate.
+LOG_MAX_BYTES = 1048576
+LOG_BACKUP_COUNT = 5
+
+##############################################################################
+# Alert dispatch settings
+##############################################################################
+
+# Number of worker threads used to send alerts
+ALERT_WORKERS = 4
+
+# Alerts a recipient gets within this many seconds of each other are
+# combined into one message, e.g. "Door 1 open 10 min, Door 3 open 12 min",
+# which saves paid SMS and API calls when several doors alert at once.
+# Alerts are held for up to this long, and are lost if the daemon dies
+# while holding them. 0 sends every alert immediately.
+ALERT_COALESCE_WINDOW = 0
+
+# A door which changes state FLAP_THRESHOLD times within FLAP_WINDOW
+# seconds, e.g. because of a bouncing sensor, is flapping. Instead of an
+# alert for every change, the recipients of its last alert get one
+# message saying it is flapping, and another once it has stayed in one
+# state for FLAP_QUIET seconds. Its open/closed alerts wait until then
+# too. Set FLAP_THRESHOLD to 0 to send every change.
+FLAP_WINDOW = 300
+FLAP_THRESHOLD = 8
+FLAP_QUIET = 300
+
+# Maximum number of concurrent sends per channel. Channels not listed here
+# may have up to 2 sends in flight at once.
+ALERT_CHANNEL_CONCURRENCY = {
+    'Email': 1,
+    'Jabber': 1
+}
+
+# Alerts are written to this file before they are sent and removed once
+# delivered, so they aren't lost if the network or the daemon goes down.
+# Set to '' to only keep undelivered alerts in memory.
+SPOOL_FILENAME = "/var/lib/pi_garage_alert/spool.db"
+
+# Failed sends are retried after SPOOL_RETRY_MIN seconds, doubling up to
+# SPOOL_RETRY_MAX seconds, until the alert is SPOOL_MAX_AGE seconds old
+SPOOL_RETRY_MIN = 5
+SPOOL_RETRY_MAX = 600
+SPOOL_MAX_AGE = 86400
+
+# How often (in seconds) to compact the spool file
+SPOOL_COMPACT_INTERVAL = 3600
+
+# Network timeout in seconds for each channel. Channels not listed here use
+# HTTP_READ_TIMEOUT if they are HTTP based, or 15 seconds otherwise.
+CHANNEL_TIMEOUTS = {
+    'Email': 30
+}
+
+# A channel that fails this many times in a row is skipped for
+# CIRCUIT_BREAKER_RESET seconds before a single send is tried again.
+# Skipped alerts stay in the spool.
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET = 60
+
+# Rate limits, as channel: (sends per second, burst). RATE_LIMITS applies
+# to everything a channel sends, RECIPIENT_RATE_LIMITS to each recipient
+# of a channel separately. Sends over the limit wait until they're
+# allowed; if more than RATE_LIMIT_MAX_QUEUED of a channel are waiting,
+# further ones are dropped. A 429 from a service pauses the channel for
+# as long as its Retry-After asks. For example:
+# RATE_LIMITS = { 'Twilio': (1, 5) }
+# RECIPIENT_RATE_LIMITS = { 'Twilio': (1 / 60.0, 3) }
+RATE_LIMITS = {}
+RECIPIENT_RATE_LIMITS = {}
+RATE_LIMIT_MAX_QUEUED = 1000
+
+##############################################################################
+# HTTP settings
+##############################################################################
+
+# Pushbullet, IFTTT, Cisco Spark and GCM share a pool of keep-alive
+# connections. Timeouts are in seconds.
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 15
+HTTP_POOL_SIZE = 4
+
+# Connections to these URLs are opened at startup so the first alert
+# doesn't have to wait for DNS, TCP and TLS setup, e.g.
+# [ 'https://api.pushbullet.com', 'https://maker.ifttt.com' ]
+HTTP_PREWARM_URLS = []
+
+# Service endpoints. Only change these to point the senders somewhere
+# else, e.g. at the local stand-ins started by tools/stub_servers.py:
+#   PUSHBULLET_URL = 'http://127.0.0.1:8025/pushbullet/v2/pushes'
+#   IFTTT_URL = 'http://127.0.0.1:8025/ifttt'
+#   GCM_URL = 'http://127.0.0.1:8025/gcm/send'
+#   SPARK_API_URL = 'http://127.0.0.1:8025/spark/v1'
+#   SLACK_API_URL = 'http://127.0.0.1:8025/slack/api/'
+# and SMTP_SERVER = '127.0.0.1', SMTP_PORT = 8026
+PUSHBULLET_URL = 'https://api.pushbullet.com/v2/pushes'
+IFTTT_URL = 'https://maker.ifttt.com'
+GCM_URL = 'https://gcm-http.googleapis.com/gcm/send'
+SPARK_API_URL = 'https://api.ciscospark.com/v1'
+SLACK_API_URL = 'https://www.slack.com/api/'
+
 ##############################################################################
 # Email settings
 ##############################################################################
@@ -56,6 +249,14 @@ EMAIL_FROM = 'Garage Door <user@example.com>'
 EMAIL_PRIORITY = '1'
 # 1 High, 3 Normal, 5 Low
 
+# Connection security: '' for plain SMTP, 'starttls' to upgrade the
+# connection with STARTTLS, or 'ssl' for SMTPS (usually port 465)
+SMTP_SECURITY = ''
+
+# The SMTP connection is kept open between emails and reopened if it has
+# been idle for longer than this many seconds
+SMTP_IDLE_TIMEOUT = 60
+
 ##############################################################################
 # Cisco Spark settings
 ##############################################################################
@@ -65,6 +266,11 @@ EMAIL_PRIORITY = '1'
 
 SPARK_ACCESSTOKEN = "" #put your access token here between the quotes.
 
+# Room IDs are looked up by title once and then cached in this file for
+# SPARK_ROOM_CACHE_TTL seconds
+SPARK_ROOM_CACHE_FILENAME = "/var/lib/pi_garage_alert/spark_rooms.json"
+SPARK_ROOM_CACHE_TTL = 86400
+
 ##############################################################################
 # Twitter settings
 ##############################################################################
@@ -105,6 +311,10 @@ JABBER_PASSWORD = ''
 #JABBER_SERVER = 'talk.google.com'
 #JABBER_PORT = 5222
 
+# If the connection drops, reconnect attempts back off exponentially up to
+# this many seconds apart
+JABBER_RETRY_MAX = 300
+
 # List of Jabber IDs allowed to perform queries
 
 JABBER_AUTHORIZED_IDS = []
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+""" Pi Garage Alert benchmarks
+
+Description: Measures the sensing and alert dispatch hot paths of
+bin/pi_garage_alert.py with simulated sensors and stub senders, so it runs
+on any Linux box. Results are written as JSON for comparing releases.
+
+Usage: tools/benchmark.py [--quick] [--output results.json] [benchmark ...]
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2013-2014 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import argparse
+import json
+import logging
+import os
+import platform
+import queue
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+##############################################################################
+# Setup shared by the benchmarks
+##############################################################################
+
+def load_daemon(**settings):
+    """Import bin/pi_garage_alert.py with a minimal config
+
+    Every benchmark runs in its own process, so the config is set once
+    before the import, just as it would be in the daemon.
+
+    Args:
+        settings: Config settings, on top of ones that keep the daemon
+                  away from the network, the disk and real hardware
+
+    Returns:
+        The pi_garage_alert module
+    """
+    cfg = types.ModuleType('pi_garage_alert_config')
+    cfg.GARAGE_DOORS = []
+    cfg.LOG_FILENAME = os.devnull
+    cfg.SENSOR_BACKEND = 'simulated'
+    cfg.SPOOL_FILENAME = ''
+    cfg.STATE_FILENAME = ''
+    cfg.JABBER_ID = ''
+    # The benchmarks cycle doors far faster than any real door, which
+    # would otherwise count as flapping and hold back their alerts
+    cfg.FLAP_THRESHOLD = 0
+    cfg.__dict__.update(settings)
+    sys.modules['pi_garage_alert_config'] = cfg
+
+    # Keep the daemon's own logging setup from writing anywhere
+    logging.basicConfig(level=logging.WARNING)
+
+    sys.path.insert(0, os.path.join(REPO_DIR, 'bin'))
+    import pi_garage_alert
+    return pi_garage_alert
+
+class StubSender:
+    """Sender that takes a fixed time per send and reports when each send
+    finished"""
+
+    def __init__(self, delay, completed):
+        self.delay = delay
+        self.completed = completed
+
+    def send(self, address, msg, submitted):
+        """Pretend to send msg to address"""
+        if self.delay:
+            time.sleep(self.delay)
+        self.completed.put((time.perf_counter(), submitted))
+        return True
+
+def register_stubs(pga, delays, completed):
+    """Register a StubSender channel and recipient type for each entry of
+    delays, a dict of recipient type to seconds per send
+
+    The recipient type 'stub_slow' gets the channel 'StubSlow', and so on.
+    """
+    for recipient_type, delay in delays.items():
+        channel = ''.join(part.capitalize() for part in recipient_type.split('_'))
+        pga.SENDERS.add_channel(channel, lambda app, delay=delay: StubSender(delay, completed))
+        # The submit time goes along with each send to time its latency
+        pga.SENDERS.add_recipient_type(recipient_type, channel,
+                                       lambda addresses, alert: [('send', (address, alert.msg, time.perf_counter()))
+                                                                 for address in addresses])
+
+def start_daemon(pga):
+    """Run PiGarageAlert.main() in the background until it has read the
+    initial state of the doors
+
+    Returns:
+        The PiGarageAlert instance
+    """
+    app = pga.PiGarageAlert()
+    threading.Thread(target=app.main, name='daemon', daemon=True).start()
+    while len(app.snapshot.doors) < len(pga.cfg.GARAGE_DOORS):
+        time.sleep(0.001)
+    return app
+
+def summarize(samples):
+    """Returns count, mean, percentiles and max of a list of seconds, in ms"""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {'count': len(ordered),
+            'mean_ms': sum(ordered) / len(ordered) * 1000,
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': ordered[-1] * 1000}
+
+def max_rss_mb():
+    """Returns the peak resident set size of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+##############################################################################
+# Benchmarks
+#
+# Each one runs in a child process and returns a JSON-serializable dict.
+##############################################################################
+
+def bench_edge_latency(mode, samples, debounce_ms=50):
+    """Time from a sensor changing level to the first alert reaching a
+    sender, for a door whose alert fires as soon as it opens"""
+    pga = load_daemon(SENSOR_MODE=mode, SENSOR_DEBOUNCE_MS=debounce_ms,
+                      GARAGE_DOORS=[{'pin': 1, 'name': 'Door',
+                                     'alerts': [{'state': 'open', 'time': 0, 'recipients': ['stub:x']}]}])
+    completed = queue.Queue()
+    register_stubs(pga, {'stub': 0}, completed)
+    app = start_daemon(pga)
+
+    latencies = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        app.sensors.set_level(1, True)
+        finished, _ = completed.get(timeout=10)
+        latencies.append(finished - start)
+
+        # Closing sends "Door is now closed"; wait for it so the door has
+        # settled before the next sample
+        app.sensors.set_level(1, False)
+        completed.get(timeout=10)
+
+    result = summarize(latencies)
+    result.update(mode=mode, debounce_ms=debounce_ms)
+    return result
+
+def bench_loop_cost(doors, iterations):
+    """Cost of one pass of the sensing loop over every door, both when
+    nothing has changed and when every door has"""
+    pga = load_daemon(GARAGE_DOORS=[{'pin': pin, 'name': 'Door %d' % (pin),
+                                     'alerts': [{'state': 'open', 'time': 3600, 'recipients': ['stub:x']},
+                                                {'state': 'open', 'time': 7200, 'recipients': ['stub:x']}]}
+                                    for pin in range(doors)])
+    register_stubs(pga, {'stub': 0}, queue.Queue())
+    door_routes = pga.compile_doors(pga.cfg.GARAGE_DOORS)
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        app = pga.PiGarageAlert()
+        app.dispatcher = pga.AlertRecorder(app.clock, output=open(os.devnull, 'w'))
+        app.checkpoint = pga.StateCheckpoint(os.path.join(state_dir, 'state.json'))
+        app.sensors = pga.SimulatedBackend()
+        app.sensors.setup(range(doors))
+        for index, door_cfg in enumerate(pga.cfg.GARAGE_DOORS):
+            door = pga.DoorState(index, door_cfg, door_routes[door_cfg['name']], 'closed', app.clock)
+            app.doors.append(door)
+            app.schedule_alert(door)
+        app.publish_snapshot()
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            app.read_doors(app.doors)
+            app.scheduler.run_due(app.clock.monotonic())
+            app.checkpoint.save_if_dirty(app.doors)
+        idle = (time.perf_counter() - start) / iterations
+
+        # Every door opens at once, so every door is rescheduled and the
+        # checkpoint saved in the same pass
+        for pin in range(doors):
+            app.sensors.set_level(pin, True)
+        start = time.perf_counter()
+        app.read_doors(app.doors)
+        app.checkpoint.save_if_dirty(app.doors)
+        changed = time.perf_counter() - start
+
+    return {'doors': doors,
+            'idle_pass_ms': idle * 1000,
+            'idle_per_door_us': idle / doors * 1e6,
+            'all_changed_pass_ms': changed * 1000,
+            'all_changed_per_door_us': changed / doors * 1e6}
+
+def bench_dispatch(recipients, alerts, slow_delay):
+    """Throughput and latency of send_alerts() fanning alerts out to many
+    recipients, with one fast channel and one slow one"""
+    pga = load_daemon()
+    completed = queue.Queue()
+    register_stubs(pga, {'stub_fast': 0, 'stub_slow': slow_delay}, completed)
+
+    routes = pga.SENDERS.compile(['stub_fast:%d' % (index) for index in range(recipients)] +
+                                 ['stub_slow:%d' % (index) for index in range(recipients)])
+    senders = {channel: pga.SENDERS.channels[channel].factory(None) for channel in ('StubFast', 'StubSlow')}
+    dispatcher = pga.AlertDispatcher(senders, pga.AlertSpool(''), max_workers=4)
+
+    call_times = []
+    start = time.perf_counter()
+    for index in range(alerts):
+        call_start = time.perf_counter()
+        pga.send_alerts(dispatcher, routes, 'Door', 'Alert %d' % (index), 'open', 0)
+        call_times.append(time.perf_counter() - call_start)
+
+    latencies = []
+    for _ in range(alerts * recipients * 2):
+        finished, submitted = completed.get(timeout=60)
+        latencies.append(finished - submitted)
+    elapsed = time.perf_counter() - start
+    dispatcher.shutdown()
+
+    stats = dispatcher.channel_stats
+    return {'recipients': recipients,
+            'alerts': alerts,
+            'slow_delay_ms': slow_delay * 1000,
+            'sends': len(latencies),
+            'sends_per_sec': len(latencies) / elapsed,
+            'send_alerts_call': summarize(call_times),
+            'send_latency': summarize(latencies),
+            'channels': {channel: stats[channel]._asdict() for channel in sorted(stats)}}
+
+def bench_startup(spawned):
+    """Time from process start until the daemon has read its doors, and
+    the memory it has used by then"""
+    import_start = time.perf_counter()
+    pga = load_daemon(GARAGE_DOORS=[{'pin': 1, 'name': 'Door',
+                                     'alerts': [{'state': 'open', 'time': 600, 'recipients': ['stub:x']}]}])
+    import_time = time.perf_counter() - import_start
+    register_stubs(pga, {'stub': 0}, queue.Queue())
+    start_daemon(pga)
+
+    # time.monotonic() is system-wide on Linux, so it can be compared with
+    # the parent's reading taken just before starting this process
+    return {'startup_ms': (time.monotonic() - spawned) * 1000,
+            'import_ms': import_time * 1000,
+            'max_rss_mb': max_rss_mb()}
+
+BENCHMARKS = {
+    'edge_latency': bench_edge_latency,
+    'loop_cost': bench_loop_cost,
+    'dispatch': bench_dispatch,
+    'startup': bench_startup,
+}
+
+def plan(quick):
+    """Returns the list of (benchmark, kwargs) runs to do"""
+    runs = [('startup', {})]
+    runs += [('edge_latency', {'mode': 'edge', 'samples': 20 if quick else 200, 'debounce_ms': debounce_ms})
+             for debounce_ms in (0, 50)]
+    runs += [('edge_latency', {'mode': 'poll', 'samples': 5 if quick else 20})]
+    runs += [('loop_cost', {'doors': doors, 'iterations': 10 if quick else 100})
+             for doors in (1, 10, 100, 1000)]
+    runs += [('dispatch', {'recipients': recipients, 'alerts': 5 if quick else 20, 'slow_delay': 0.02})
+             for recipients in (1, 10, 50)]
+    return runs
+
+##############################################################################
+# Main functionality
+##############################################################################
+
+def run_child(name, kwargs):
+    """Run one benchmark in a fresh interpreter and return its result"""
+    if name == 'startup':
+        kwargs = dict(kwargs, spawned=time.monotonic())
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                      '--child', name, json.dumps(kwargs)])
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+def git_revision():
+    """Returns the git revision being benchmarked, if known"""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    """Main functionality"""
+    parser = argparse.ArgumentParser(description="Benchmark the Pi Garage Alert hot paths")
+    parser.add_argument('--quick', action='store_true', help="fewer samples, for a quick check")
+    parser.add_argument('--output', '-o', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--child', nargs=2, metavar=('NAME', 'KWARGS'), help=argparse.SUPPRESS)
+    parser.add_argument('benchmarks', nargs='*', help="benchmarks to run, default all (%s)" % (', '.join(sorted(BENCHMARKS))))
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: %s" % (name))
+
+    if args.child:
+        name, kwargs = args.child
+        print(json.dumps(BENCHMARKS[name](**json.loads(kwargs))))
+        return
+
+    results = []
+    for name, kwargs in plan(args.quick):
+        if args.benchmarks and name not in args.benchmarks:
+            continue
+        print("Running %s %s" % (name, kwargs), file=sys.stderr)
+        results.append({'benchmark': name, 'params': kwargs, 'result': run_child(name, kwargs)})
+
+    report = {'format': 1,
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'revision': git_revision(),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'platform': platform.platform(),
+              'quick': args.quick,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+""" Pi Garage Alert stub servers
+
+Description: Local stand-ins for the services Pi Garage Alert sends to: an
+SMTP sink, and one HTTP server mimicking the Pushbullet, IFTTT Maker, GCM,
+Cisco Spark and Slack calls the senders make. Every service can be made
+slow or unreliable, to test delivery behaviour and load test alert storms
+without touching the network.
+
+Point the daemon at them with these settings in pi_garage_alert_config.py
+(ports are the defaults):
+
+    PUSHBULLET_URL = 'http://127.0.0.1:8025/pushbullet/v2/pushes'
+    IFTTT_URL = 'http://127.0.0.1:8025/ifttt'
+    GCM_URL = 'http://127.0.0.1:8025/gcm/send'
+    SPARK_API_URL = 'http://127.0.0.1:8025/spark/v1'
+    SLACK_API_URL = 'http://127.0.0.1:8025/slack/api/'
+    SMTP_SERVER = '127.0.0.1'
+    SMTP_PORT = 8026
+    SMTP_SECURITY = ''
+
+Request counts per service are served as JSON at /_stats on the HTTP port,
+and printed on exit.
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2013-2014 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import random
+import re
+import signal
+import sys
+import time
+from urllib.parse import urlsplit, parse_qs
+
+SERVICES = ('smtp', 'pushbullet', 'ifttt', 'gcm', 'spark', 'slack')
+
+##############################################################################
+# Fault injection
+##############################################################################
+
+class Faults:
+    """How badly a stub service behaves
+
+    Each request waits latency seconds, plus up to jitter more. It then
+    hangs with probability hang_rate, is rate limited with probability
+    rate_limit_rate, fails with probability error_rate, and otherwise
+    succeeds. A hung request never gets a response; the connection stays
+    open until the client gives up.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1,
+                 hang_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.hang_rate = hang_rate
+
+    def outcome(self):
+        """Returns 'hang', 'rate_limited', 'error' or 'ok' for a request"""
+        roll = random.random()
+        for outcome, rate in (('hang', self.hang_rate),
+                              ('rate_limited', self.rate_limit_rate),
+                              ('error', self.error_rate)):
+            if roll < rate:
+                return outcome
+            roll -= rate
+        return 'ok'
+
+    async def delay(self):
+        """Wait for the configured latency"""
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+async def hang(reader):
+    """Never answer; just wait for the client to close the connection"""
+    while await reader.read(4096):
+        pass
+
+##############################################################################
+# HTTP stubs
+##############################################################################
+
+class HttpStubs:
+    """Pushbullet, IFTTT Maker, GCM, Cisco Spark and Slack stand-ins, served
+    from one port under /pushbullet, /ifttt, /gcm, /spark and /slack
+
+    Connections are kept alive like the real services, so the daemon's
+    connection pooling behaves as it would in production.
+    """
+
+    def __init__(self, faults, stats, verbose=False):
+        self.logger = logging.getLogger(__name__)
+        self.faults = faults
+        self.stats = stats
+        self.verbose = verbose
+        self.ids = itertools.count(1)
+
+        # Cisco Spark rooms, title -> ID
+        self.spark_rooms = collections.OrderedDict()
+
+    async def handle_connection(self, reader, writer):
+        """Answer HTTP requests on a connection until the client closes it"""
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                service = target.split('/')[1] if target.count('/') > 1 else ''
+                if self.verbose:
+                    self.logger.info("%s %s", method, target)
+
+                if service in self.faults:
+                    stats = self.stats[service]
+                    stats['requests'] += 1
+                    faults = self.faults[service]
+                    await faults.delay()
+                    outcome = faults.outcome()
+                    stats[outcome] += 1
+                    if outcome == 'hang':
+                        await hang(reader)
+                        break
+                    if outcome == 'rate_limited':
+                        response = (429, {'Retry-After': str(faults.retry_after)},
+                                    {'ok': False, 'error': 'ratelimited'})
+                    elif outcome == 'error':
+                        response = (500, {}, {'error': 'Injected failure'})
+                    else:
+                        response = self.respond(service, method, target, headers, body)
+                elif target == '/_stats':
+                    response = (200, {}, self.stats)
+                else:
+                    response = (404, {}, {'error': 'Not found'})
+
+                self.write_response(writer, *response)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_request(reader):
+        """Returns (method, target, headers, body) of the next request, or
+        None if the client closed the connection"""
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+
+        headers = dict()
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if line == '':
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return method, target, headers, body
+
+    @staticmethod
+    def write_response(writer, status, headers, document):
+        """Send a response, with document as the JSON body or plain text"""
+        if isinstance(document, str):
+            content_type, body = 'text/plain', document.encode('utf-8')
+        else:
+            content_type, body = 'application/json', json.dumps(document).encode('utf-8')
+        lines = ['HTTP/1.1 %d %s' % (status, 'OK' if status == 200 else 'Stub'),
+                 'Content-Type: %s' % (content_type),
+                 'Content-Length: %d' % (len(body))]
+        lines += ['%s: %s' % (name, value) for name, value in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+    def respond(self, service, method, target, headers, body):
+        """Returns (status, headers, document) for a successful request"""
+        path = urlsplit(target).path
+        request_id = next(self.ids)
+
+        if service == 'pushbullet' and method == 'POST':
+            return 200, {}, {'active': True, 'iden': 'stub%d' % (request_id), 'type': 'note'}
+        if service == 'ifttt' and method == 'POST':
+            match = re.match(r'^/ifttt/trigger/([^/]+)/with/key/', path)
+            if match:
+                return 200, {}, "Congratulations! You've fired the %s event" % (match.group(1))
+        if service == 'gcm' and method == 'POST':
+            return 200, {}, {'message_id': request_id}
+        if service == 'slack' and method == 'POST':
+            return 200, {}, {'ok': True, 'ts': '%.6f' % (time.time())}
+        if service == 'spark':
+            return self.respond_spark(method, target, headers, body, request_id)
+        return 404, {}, {'error': 'Not found'}
+
+    def respond_spark(self, method, target, headers, body, request_id):
+        """Cisco Spark rooms and messages, with paginated room listing"""
+        url = urlsplit(target)
+        if url.path == '/spark/v1/rooms' and method == 'GET':
+            query = parse_qs(url.query)
+            page_size = int(query.get('max', ['100'])[0])
+            start = int(query.get('cursor', ['0'])[0])
+            rooms = list(self.spark_rooms.items())[start:start + page_size]
+            response_headers = {}
+            if start + page_size < len(self.spark_rooms):
+                response_headers['Link'] = '<http://%s/spark/v1/rooms?max=%d&cursor=%d>; rel="next"' % (
+                    headers.get('host', ''), page_size, start + page_size)
+            return 200, response_headers, {'items': [{'id': room_id, 'title': title} for title, room_id in rooms]}
+
+        document = json.loads(body.decode('utf-8') or '{}')
+        if url.path == '/spark/v1/rooms' and method == 'POST':
+            room_id = 'room%d' % (request_id)
+            self.spark_rooms[document.get('title')] = room_id
+            return 200, {}, {'id': room_id, 'title': document.get('title')}
+        if url.path == '/spark/v1/messages' and method == 'POST':
+            if document.get('roomId') not in self.spark_rooms.values():
+                return 404, {}, {'message': 'Room not found'}
+            return 200, {}, {'id': 'message%d' % (request_id), 'roomId': document['roomId']}
+        return 404, {}, {'error': 'Not found'}
+
+##############################################################################
+# SMTP sink
+##############################################################################
+
+class SmtpSink:
+    """Accepts and discards mail, speaking just enough SMTP for smtplib
+
+    Faults apply per message: the latency is spent before replying to the
+    end of the message data, errors are a 451 reply, rate limiting is a
+    421 reply and disconnect, and a hang never replies at all.
+    """
+
+    def __init__(self, faults, stats, verbose=False):
+        self.logger = logging.getLogger(__name__)
+        self.faults = faults
+        self.stats = stats
+        self.verbose = verbose
+
+    async def handle_connection(self, reader, writer):
+        """Run one SMTP session"""
+        stats = self.stats['smtp']
+        faults = self.faults['smtp']
+
+        def reply(line):
+            writer.write((line + '\r\n').encode('ascii'))
+
+        try:
+            reply('220 stub ESMTP')
+            while True:
+                line = (await reader.readline()).decode('utf-8', 'replace').rstrip('\r\n')
+                if line == '':
+                    break
+                command = line.split(' ', 1)[0].upper()
+
+                if command == 'EHLO':
+                    writer.write(b'250-stub\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n')
+                elif command == 'AUTH':
+                    # Accept any credentials
+                    if line.upper().startswith('AUTH LOGIN') and len(line.split()) < 3:
+                        reply('334 VXNlcm5hbWU6')
+                        await reader.readline()
+                    if line.upper().startswith('AUTH LOGIN'):
+                        reply('334 UGFzc3dvcmQ6')
+                        await reader.readline()
+                    reply('235 Authentication successful')
+                elif command == 'DATA':
+                    reply('354 End data with <CR><LF>.<CR><LF>')
+                    while (await reader.readline()) not in (b'.\r\n', b'.\n', b''):
+                        pass
+
+                    stats['requests'] += 1
+                    await faults.delay()
+                    outcome = faults.outcome()
+                    stats[outcome] += 1
+                    if self.verbose:
+                        self.logger.info("SMTP message: %s", outcome)
+                    if outcome == 'hang':
+                        await hang(reader)
+                        break
+                    if outcome == 'rate_limited':
+                        reply('421 Too many messages, try again later')
+                        break
+                    reply('451 Injected failure' if outcome == 'error' else '250 Message accepted')
+                elif command == 'QUIT':
+                    reply('221 Bye')
+                    break
+                elif command in ('HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP'):
+                    reply('250 OK')
+                else:
+                    reply('502 Command not implemented')
+                await writer.drain()
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+##############################################################################
+# Main functionality
+##############################################################################
+
+async def serve(args, faults, stats):
+    """Run the HTTP and SMTP stubs until interrupted"""
+    logger = logging.getLogger(__name__)
+    http = await asyncio.start_server(HttpStubs(faults, stats, args.verbose).handle_connection,
+                                      args.address, args.http_port)
+    smtp = await asyncio.start_server(SmtpSink(faults, stats, args.verbose).handle_connection,
+                                      args.address, args.smtp_port)
+    logger.info("HTTP stubs listening on %s:%d, SMTP sink on %s:%d",
+                args.address, args.http_port, args.address, args.smtp_port)
+    async with http, smtp:
+        await asyncio.gather(http.serve_forever(), smtp.serve_forever())
+
+def main():
+    """Main functionality"""
+    parser = argparse.ArgumentParser(description="Local stand-ins for the services Pi Garage Alert sends to")
+    parser.add_argument('--address', default='127.0.0.1', help="address to listen on (default %(default)s)")
+    parser.add_argument('--http-port', type=int, default=8025, help="HTTP port (default %(default)s)")
+    parser.add_argument('--smtp-port', type=int, default=8026, help="SMTP port (default %(default)s)")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds to wait before each response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="up to this many extra seconds of latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="fraction of requests that get a 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds sent with a 429")
+    parser.add_argument('--hang-rate', type=float, default=0.0, help="fraction of requests that never get a response")
+    parser.add_argument('--faults', metavar='JSON',
+                        help="per-service overrides, e.g. '{\"smtp\": {\"error_rate\": 0.5}}'")
+    parser.add_argument('--verbose', '-v', action='store_true', help="log every request")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)-15s %(levelname)-8s %(message)s', level=logging.INFO)
+
+    defaults = {'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate,
+                'rate_limit_rate': args.rate_limit_rate, 'retry_after': args.retry_after,
+                'hang_rate': args.hang_rate}
+    overrides = json.loads(args.faults) if args.faults else {}
+    for service in overrides:
+        if service not in SERVICES:
+            parser.error("unknown service in --faults: %s" % (service))
+    faults = {service: Faults(**dict(defaults, **overrides.get(service, {}))) for service in SERVICES}
+    stats = {service: collections.Counter() for service in SERVICES}
+
+    # Print the stats when stopped with kill as well as with Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        asyncio.run(serve(args, faults, stats))
+    except KeyboardInterrupt:
+        pass
+    except OSError as ex:
+        logging.critical("Unable to start: %s", ex)
+        sys.exit(1)
+    finally:
+        print(json.dumps(stats, indent=2, sort_keys=True))
+
+if __name__ == "__main__":
+    main()